@@ -0,0 +1,49 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def temp_path():
+    return uuid.uuid4().hex + '.mp3'
+
+
+def build_move_chains(sources, targets, make_temp=temp_path):
+    # blocker[i] is the item that currently occupies the target of item i and has to move away first;
+    # every path is a source and a target at most once, so items form disjoint chains and cycles
+    by_source = dict((source, i) for i, source in enumerate(sources))
+    blocker = [by_source.get(target) for target in targets]
+    blocked = set(j for i, j in enumerate(blocker) if j is not None and j != i)
+    done = [source == target for source, target in zip(sources, targets)]
+
+    def walk(i):
+        order = []
+        while i is not None and not done[i]:
+            done[i] = True
+            order.append(i)
+            i = blocker[i]
+        return order
+
+    chains = []
+    for i in range(len(sources)):
+        if not done[i] and i not in blocked:
+            order = walk(i)
+            chains.append([(sources[j], targets[j]) for j in reversed(order)])
+    for i in range(len(sources)):
+        if not done[i]:
+            order = walk(i)
+            temp = make_temp()
+            chain = [(sources[i], temp)]
+            chain += [(sources[j], targets[j]) for j in reversed(order[1:])]
+            chain.append((temp, targets[i]))
+            chains.append(chain)
+    return chains
+
+
+def run_tasks(tasks, jobs):
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            task()
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(task) for task in tasks]
+        for future in futures:
+            future.result()
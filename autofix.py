@@ -1,17 +1,26 @@
 import os
+import argparse
 import posixpath
 import re
 import regex
 import functools
+from concurrent.futures import ProcessPoolExecutor
 from unidecode import unidecode
 from itertools import zip_longest
 
-from config import snapshot_root, music_root
+from config import snapshot_root, music_root, snapshot_name
 from collection import Snapshots, Collection
+from snapshots import verify_levels, verify_full
+from fix_state import FixState, fingerprint
+from metrics import metrics, report_path
+from progress import ConsoleProgress
+import snapshot_parser
 from my_tags import *
 
 
 unsorted_folder = '__Unsorted'
+# bump whenever fix() starts producing different results, so that stored results are discarded
+rules_version = 1
 
 
 def recursive_apply(f):
@@ -23,13 +32,28 @@ def recursive_apply(f):
     return g
 
 
+memoized = []
+
+
+def memoize(f):
+    # the same album, artist and title strings repeat across thousands of tracks
+    f = functools.lru_cache(maxsize=1 << 16)(f)
+    memoized.append(f)
+    return f
+
+
+def normalizer_cache_info():
+    return dict((f.__name__, f.cache_info()) for f in memoized)
+
+
 roman_number_pattern = re.compile(
     r'\b(?i:(?=[MDCLXVI])((M{0,3})((C[DM])|(D?C{0,3}))?((X[LC])|(L?X{0,3})|L)?((I[VX])|(V?(I{0,3}))|V)?))\b'
 )
+number_pattern = re.compile(r'\d+')
 
 
 def extract_number(tags, key):
-    number = (re.findall(r'\d+', tags[key]) or [''])[0]
+    number = (number_pattern.findall(tags[key]) or [''])[0]
     tags[key] = number
     return number
 
@@ -41,29 +65,49 @@ def align(tags, number_key, digits_key, default_digits):
         tags[number_key] = '0' * (int(digits) - len(number)) + number
 
 
+def upper_match(match):
+    return match.group(0).upper()
+
+
+trim_pattern = re.compile(r'^\s+|\s+$')
+spaces_pattern = re.compile(r'\s+')
+case_rules = [
+    (re.compile(r'(^|(?<=[^\w\'])|(?<=\W\'))\w'), upper_match),  # mixed case
+    (re.compile(r'(?<=\bO\')\w'), upper_match),  # for cases like O'Bannon
+    (roman_number_pattern, upper_match),  # fix roman numbers
+    (re.compile(r'\'M\b'), r"'m"),
+    (re.compile(r'\bMIX\b'), r'Mix'),
+    (re.compile(r'\bOst\b'), r'OST'),
+    (re.compile(r'\bDj\b'), r'DJ'),
+]
+
+
 @recursive_apply
+@memoize
 def capitalize(s):
-    s = re.sub(r'^\s+|\s+$', r'', s)  # trim
-    s = re.sub(r'\s+', r' ', s)  # remove extra spaces
+    s = trim_pattern.sub(r'', s)  # trim
+    s = spaces_pattern.sub(r' ', s)  # remove extra spaces
     s = s.lower()
-    s = re.sub(r'(^|(?<=[^\w\'])|(?<=\W\'))\w', lambda match: match.group(0).upper(), s)  # mixed case
-    s = re.sub(r'(?<=\bO\')\w', lambda match: match.group(0).upper(), s)  # for cases like O'Bannon
-    s = re.sub(roman_number_pattern, lambda match: match.group(0).upper(), s)  # fix roman numbers
-    s = re.sub(r'\'M\b', r"'m", s)
-    s = re.sub(r'\bMIX\b', r'Mix', s)
-    s = re.sub(r'\bOst\b', r'OST', s)
-    s = re.sub(r'\bDj\b', r'DJ', s)
+    for pattern, repl in case_rules:
+        s = pattern.sub(repl, s)
     return s
 
 
+dashes_pattern = regex.compile(r'(^|\s)\p{Pd}+(\s|$)')
+
+
 @recursive_apply
+@memoize
 def fix_dashes(s):
-    return regex.sub(r'(^|\s)\p{Pd}+(\s|$)', r'\1–\2', s)
+    return dashes_pattern.sub(r'\1–\2', s)
+
+
+pre_pattern = re.compile(r'\[Pre-')
 
 
 @recursive_apply
 def fix_pre(s):
-    return re.sub(r'\[Pre-', '[pre-', s)
+    return pre_pattern.sub('[pre-', s)
 
 
 def fix_exception(tags, key, exception_key):
@@ -72,49 +116,62 @@ def fix_exception(tags, key, exception_key):
     tags[key] = tags[exception_key] or tags[key]
 
 
+extension_patterns = [
+    re.compile(r" \[.*\]$"),
+    re.compile(r" \{.*\}$"),
+]
+
+
 @recursive_apply
+@memoize
 def remove_extentions(s):
-    s = re.sub(r" \[.*\]$", '', s)
-    s = re.sub(r" \{.*\}$", '', s)
+    for pattern in extension_patterns:
+        s = pattern.sub('', s)
     return s
 
 
+rym_special_characters = {
+    '–': '_',
+    '[': '[',
+    ']': ']',
+}
+rym_latin_pattern = regex.compile(r'\p{IsLatin}|\p{ASCII}')
+rym_latin_characters = {
+    'þ': 'd',
+}
+rym_ascii_characters = {
+    ' ': '_',
+    '&': 'and',
+    '"': '',
+    "'": '',
+}
+non_word_pattern = re.compile(r'\W')
+
+
+@memoize
 def rym_escape_character(s):
     s = s.lower()
 
-    d = {
-        '–': '_',
-        '[': '[',
-        ']': ']',
-    }
-    if s in d:
-        return d[s]
+    if s in rym_special_characters:
+        return rym_special_characters[s]
 
-    if not regex.fullmatch(r'\p{IsLatin}|\p{ASCII}', s):
+    if not rym_latin_pattern.fullmatch(s):
         return s
 
-    d = {
-        'þ': 'd',
-    }
-    if s in d:
-        return d[s]
+    if s in rym_latin_characters:
+        return rym_latin_characters[s]
 
     s = unidecode(s)
-    d = {
-        ' ': '_',
-        '&': 'and',
-        '"': '',
-        "'": '',
-    }
-    if s in d:
-        return d[s]
-
-    if re.fullmatch(r'\W', s):
+    if s in rym_ascii_characters:
+        return rym_ascii_characters[s]
+
+    if non_word_pattern.fullmatch(s):
         return '_'
     return s
 
 
 @recursive_apply
+@memoize
 def rym_escape(s):
     return ''.join(map(rym_escape_character, s))
 
@@ -145,22 +202,28 @@ def compress(s):
     return s
 
 
+rym_type_patterns = [
+    (re.compile(r'\b(EP|Demo)\b'), 'ep'),
+    (re.compile(r'\bSingle\b'), 'single'),
+    (re.compile(r'\bCompilation\b'), 'comp'),
+]
+
+
 def set_rym_values(tags):
     tags[RYMARTIST] = rym_escape(remove_extentions(' and '.join(tags[ALBUMARTIST])))
     tags[RYMALBUM] = rym_escape(tags[ALBUM])
 
-    for pattern, rym_type in [
-        (r'\b(EP|Demo)\b', 'ep'),
-        (r'\bSingle\b', 'single'),
-        (r'\bCompilation\b', 'comp'),
-    ]:
-        if re.search(pattern, tags[ALBUMAPPENDIX]):
+    for pattern, rym_type in rym_type_patterns:
+        if pattern.search(tags[ALBUMAPPENDIX]):
             tags[RYMTYPE] = rym_type
             break
     else:
         tags[RYMTYPE] = 'album'
 
 
+path_character_pattern = re.compile(r'[/\\?*"<>|:]')
+
+
 def set_path(tags):
     extension = tags[PATH].split('.')[-1]
 
@@ -191,7 +254,7 @@ def set_path(tags):
     ]
     if tags[PATH].startswith(unsorted_folder + os.sep):
         tokens.insert(0, unsorted_folder)
-    tokens = [re.sub(r'[/\\?*"<>|:]', '-', token) for token in tokens]
+    tokens = [path_character_pattern.sub('-', token) for token in tokens]
     path = posixpath.join(*tokens)
     tags[PATH] = path
 
@@ -236,26 +299,106 @@ def fix(tags):
     set_path(tags)
 
 
-def fix_cs(snapshots, cs):
+def fix_record(snapshots, fs):
+    my_tags = MyTags(snapshots, fs)
+    fix(my_tags)
+    my_tags.write(fs)
+
+
+worker_snapshots = None
+
+
+def init_worker(snapshots):
+    global worker_snapshots
+    worker_snapshots = snapshots
+    metrics.reset()
+
+
+def fix_chunk(chunk):
+    for fs in chunk:
+        fix_record(worker_snapshots, fs)
+    return chunk, metrics.take()
+
+
+def fix_records(snapshots, records, jobs=1):
+    if jobs <= 1 or len(records) <= 1:
+        for fs in records:
+            fix_record(snapshots, fs)
+        return
+    # records keep their order, so the result does not depend on the number of processes
+    chunk_size = max(1, min(256, len(records) // (4 * jobs)))
+    chunks = [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(snapshots,))
+    with executor:
+        for chunk, (fixed, worker_metrics) in zip(chunks, executor.map(fix_chunk, chunks)):
+            metrics.merge(worker_metrics)
+            for fs, fixed_fs in zip(chunk, fixed):
+                fs.update(fixed_fs)
+
+
+@metrics.timed('fix')
+def fix_cs(snapshots, cs, state=None, jobs=1):
+    pending = []
     for fs in cs:
         if fs['path'].startswith(unsorted_folder + os.sep):
             continue
-        my_tags = MyTags(snapshots, fs)
-        fix(my_tags)
-        my_tags.write(fs)
+        if state is None:
+            pending.append((None, None, fs))
+            continue
+        key = fingerprint(fs)
+        found, result = state.lookup(key)
+        if not found:
+            pending.append((key, dict(fs), fs))
+            continue
+        metrics.count('records_reused')
+        if result is not None:
+            fs['path'], fs['tags'] = result
+            fs['modified'] = -1
+
+    fix_records(snapshots, [fs for _, _, fs in pending], jobs)
+    metrics.count('records_fixed', len(pending))
+
+    if state is not None:
+        for key, original, fs in pending:
+            state.store(key, original, fs)
 
 
 if __name__ == '__main__':
-    snapshots = Snapshots(snapshot_root)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='number of scanning and fixing processes')
+    parser.add_argument('--verify', choices=verify_levels, default=verify_full, help='serialization check level')
+    parser.add_argument('--subpath', default='', help='only scan this file or folder relative to the music root')
+    parser.add_argument('--metrics', help='where to write the metrics report of the run')
+    parser.add_argument('--full', action='store_true', help='fix every record, ignoring the results of the previous run')
+    args = parser.parse_args()
+
+    snapshots = Snapshots(snapshot_root, verify=args.verify)
     try:
-        cs = snapshots.load('data.json')
+        cs = snapshots.load(snapshot_name)
     except FileNotFoundError:
         cs = None
-    collection = Collection(snapshots, music_root, expected_cs=cs)
+    collection = Collection(
+        snapshots, music_root, expected_cs=cs, need_update=False, jobs=args.jobs, progress=ConsoleProgress()
+    )
+    if collection.resume_apply() is None:
+        collection.update(subpath=args.subpath)
     cs = collection.state
     cs = sorted(cs, key=lambda fs: fs['path'])
 
-    fix_cs(snapshots, cs)
-    
-    snapshots.save(cs, 'data.json', sort=False)
+    state = FixState(snapshots, rules_version)
+    if not args.full:
+        state.load()
+    fix_cs(snapshots, cs, state, jobs=args.jobs)
+    print('Fixed %d records, reused %d' % (state.fixed, state.reused))
+
+    snapshots.save(cs, snapshot_name, sort=False)
+    state.save()
     collection.remove_unused_pictures()
+
+    metrics.save(
+        args.metrics or report_path(snapshot_root, 'autofix'),
+        verification=snapshots.verification_stats.as_dict(),
+        snapshot_parser=snapshot_parser.cache_info(),
+        pictures=snapshots.pictures.cache_info(),
+        normalizers=normalizer_cache_info(),
+    )
@@ -0,0 +1,146 @@
+import io
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import posixpath
+import contextlib
+from copy import deepcopy
+
+import mutagen.id3
+
+from collection import Collection
+from snapshots import Snapshots
+from benchmarks.snapshot_formats import time_call, benchmark_formats
+import autofix
+
+
+def album_frames(rng, album, cover):
+    artist = f'artist {album // 3}'
+    return [
+        mutagen.id3.TALB(encoding=3, text=[f'the album number {album} (deluxe edition)']),
+        mutagen.id3.TPE2(encoding=3, text=[artist]),
+        mutagen.id3.TDRC(encoding=3, text=[str(1960 + rng.randrange(60))]),
+        mutagen.id3.TCON(encoding=3, text=[f'Genre {album % 20}']),
+        mutagen.id3.TXXX(encoding=3, desc='COUNTRY', text=[f'Country {album % 10}']),
+        mutagen.id3.TXXX(encoding=3, desc='GROUP', text=[f'group {album % 5}']),
+        mutagen.id3.APIC(encoding=0, mime='image/jpeg', type=3, desc='', data=cover),
+    ]
+
+
+def track_frames(album, track, tracks):
+    return [
+        mutagen.id3.TIT2(encoding=3, text=[f'track {track} – part {track % 3} ii']),
+        mutagen.id3.TPE1(encoding=3, text=[f'artist {album // 3}', f'guest {track % 7}']),
+        mutagen.id3.TRCK(encoding=3, text=[f'{track + 1}/{tracks}']),
+        mutagen.id3.COMM(encoding=3, lang='eng', desc='', text=['ripped for benchmarks']),
+    ]
+
+
+def generate_library(music_root, albums, tracks, audio_bytes, cover_bytes=200 << 10, seed=0):
+    # every album shares one cover; the audio of every track is unique
+    rng = random.Random(seed)
+    for album in range(albums):
+        cover = rng.randbytes(cover_bytes)
+        frames = album_frames(rng, album, cover)
+        folder = posixpath.join(music_root, f'group {album % 5}', f'artist {album // 3}', f'album {album}')
+        os.makedirs(folder, exist_ok=True)
+        for track in range(tracks):
+            path = posixpath.join(folder, f'{track + 1:02} track {track}.mp3')
+            with open(path, 'wb') as f:
+                f.write(rng.randbytes(audio_bytes))
+            tags = mutagen.id3.ID3()
+            for frame in frames + track_frames(album, track, tracks):
+                tags.add(frame)
+            tags.save(path)
+
+
+def edit_snapshot(cs, fraction=0.25):
+    # renames some albums, retags some tracks and drops the cover of some albums
+    target = deepcopy(cs)
+    albums = sorted(set(posixpath.dirname(fs['path']) for fs in target))
+    step = max(1, round(1 / fraction))
+    renamed = set(albums[0::step])
+    retagged = set(albums[1::step])
+    uncovered = set(albums[2::step])
+    for fs in target:
+        folder, name = posixpath.split(fs['path'])
+        if folder in renamed:
+            fs['path'] = posixpath.join(folder + ' (remastered)', name)
+        if folder in retagged:
+            fs['tags'] = sorted(fs['tags'] + ["TXXX(desc='BENCHMARK', text=['retagged'])"])
+        if folder in uncovered:
+            fs['tags'] = [tag for tag in fs['tags'] if not tag.startswith('APIC')]
+    return target
+
+
+def quiet_call(f):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return time_call(f)
+
+
+def benchmark_library(root, albums, tracks, audio_bytes, jobs=1):
+    music_root = posixpath.join(root, 'music')
+    snapshot_root = posixpath.join(root, 'snapshots')
+    results = {}
+
+    seconds, _ = time_call(lambda: generate_library(music_root, albums, tracks, audio_bytes))
+    results['generate'] = {'seconds': seconds}
+
+    snapshots = Snapshots(snapshot_root)
+    seconds, collection = quiet_call(lambda: Collection(snapshots, music_root, jobs=jobs))
+    results['update_cold'] = {'seconds': seconds, 'records': len(collection.state)}
+
+    snapshots = Snapshots(snapshot_root)
+    seconds, collection = quiet_call(lambda: Collection(snapshots, music_root, jobs=jobs))
+    results['update_warm'] = {'seconds': seconds, 'records': len(collection.state)}
+
+    cs = sorted(collection.state, key=lambda fs: fs['path'])
+    fixed = deepcopy(cs)
+    seconds, _ = time_call(lambda: autofix.fix_cs(snapshots, fixed, jobs=jobs))
+    results['fix_cs'] = {'seconds': seconds, 'changed': sum(a != b for a, b in zip(cs, fixed))}
+
+    results['formats'] = benchmark_formats(cs, snapshot_root)
+
+    target = edit_snapshot(cs)
+    seconds, report = quiet_call(lambda: collection.apply_snapshot(target, jobs=jobs))
+    results['apply'] = dict(vars(report), seconds=seconds)
+
+    seconds, removed = time_call(collection.remove_unused_pictures)
+    results['picture_gc'] = {'seconds': seconds, 'removed': len(removed)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--albums', type=int, default=20)
+    parser.add_argument('--tracks', type=int, default=10)
+    parser.add_argument('--audio-mb', type=float, default=2, help='size of the audio of every track')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--root', help='work directory, a temporary one is removed after the run')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp()
+    try:
+        results = benchmark_library(root, args.albums, args.tracks, int(args.audio_mb * (1 << 20)), args.jobs)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root)
+
+    for name, result in results.items():
+        if name != 'formats':
+            details = ', '.join(f'{key} {value}' for key, value in result.items() if key != 'seconds')
+            print(f"{name:12} {result['seconds']:8.3f}s  {details}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'parameters': vars(args),
+                'results': results,
+            }, f, indent=4)
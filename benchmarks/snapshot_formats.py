@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import posixpath
+
+from snapshots import Snapshots
+
+
+def synthetic_snapshot(albums, tracks):
+    cs = []
+    for album in range(albums):
+        artist = f'Artist {album // 3}'
+        album_tags = [
+            f"TALB(text=['Album {album}'])",
+            f"TPE2(text=['{artist}'])",
+            f"TDRC(text=['{1970 + album % 50}'])",
+            f"TCON(text=['Genre {album % 20}'])",
+            f"TXXX(desc='COUNTRY', text=['Country {album % 10}'])",
+            f"TXXX(desc='GROUP', text=['Group {album % 5}'])",
+            f"TXXX(desc='RYMALBUM', text=['album_{album}'])",
+            f"APIC(encoding=Encoding.UTF8, path='{hashlib.md5(str(album).encode()).hexdigest()}.jpg')",
+        ]
+        for track in range(tracks):
+            path = f'Group {album % 5}/Country {album % 10}/{artist}/{album} – Album {album}/{track + 1:02}. Title.mp3'
+            cs.append({
+                'path': path,
+                'modified': 1600000000 + album * tracks + track,
+                'hash': hashlib.md5(path.encode()).hexdigest(),
+                'tags': sorted(album_tags + [
+                    f"TIT2(text=['Title {track}'])",
+                    f"TPE1(text=['{artist}'])",
+                    f"TRCK(text=['{track + 1:02}'])",
+                ]),
+            })
+    return cs
+
+
+def time_call(f):
+    start = time.perf_counter()
+    result = f()
+    return time.perf_counter() - start, result
+
+
+def benchmark_formats(cs, root, names=('data.json', 'data.jsonl', 'data.msnap')):
+    snapshots = Snapshots(root)
+    results = {}
+    for name in names:
+        save_time, _ = time_call(lambda: snapshots.save(cs, name))
+        load_time, loaded = time_call(lambda: snapshots.load(name))
+        assert len(loaded) == len(cs)
+        results[name] = {
+            'records': len(cs),
+            'bytes': os.path.getsize(posixpath.join(root, name)),
+            'save_seconds': save_time,
+            'load_seconds': load_time,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--albums', type=int, default=2000)
+    parser.add_argument('--tracks', type=int, default=12)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        results = benchmark_formats(synthetic_snapshot(args.albums, args.tracks), root)
+    finally:
+        shutil.rmtree(root)
+    for name, result in results.items():
+        print(f"{name:12} {result['bytes']:>12} bytes  save {result['save_seconds']:.3f}s  load {result['load_seconds']:.3f}s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -1,18 +1,66 @@
 import os
 import posixpath
-from collections import OrderedDict
 import hashlib
 import tempfile
 import shutil
-import uuid
-from copy import deepcopy
+import threading
+from collections import OrderedDict, Counter
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
-from mutagen.id3 import ID3
+from mutagen.id3 import ID3, BitPaddedInt
+from mutagen.id3._id3v1 import find_id3v1
 
 from snapshots import Snapshots
+from scan_index import ScanIndex
+from apply_plan import build_move_chains, run_tasks
+from journal import ApplyJournal
+from snapshot_diff import diff_snapshots, SubtreeMismatchError
+from tag_writer import save_in_place, save_by_copy, restore_backup, restore_backups, is_copy_temp, remove_copy_temps
+from metrics import metrics
+from progress import ProgressEvent, file_started, file_reused, file_hashed
+
+
+hash_chunk_size = 1 << 20
+
+
+def get_audio_bounds(f):
+    f.seek(0, 2)
+    end = f.tell()
+    tag, offset = find_id3v1(f)
+    if tag is not None:
+        end += offset
+    f.seek(0)
+    start = 0
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+        start = min(BitPaddedInt(header[6:10]) + 10, end)
+    return start, end
+
+
+def empty_id3_header(trailing_size):
+    # what mutagen writes for an empty tag with its default padding
+    padding = 1024 + trailing_size // 1000
+    return b'ID3\x04\x00\x00' + BitPaddedInt.to_str(padding, width=4) + b'\x00' * padding
 
 
 def get_mp3_hash(path):
+    with metrics.phase('hash'), open(path, 'rb') as f:
+        start, end = get_audio_bounds(f)
+        metrics.count('bytes_hashed', end - start)
+        md5 = hashlib.md5(empty_id3_header(end - start))
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            chunk = f.read(min(hash_chunk_size, left))
+            if not chunk:
+                break
+            md5.update(chunk)
+            left -= len(chunk)
+        return md5.hexdigest()
+
+
+def get_mp3_hash_by_copy(path):
     with tempfile.TemporaryDirectory() as td:
         tf = posixpath.join(td, 'a.mp3')
         shutil.copy2(path, tf)
@@ -27,13 +75,59 @@ def modified_timestamp(path):
     return int(posixpath.getmtime(path))
 
 
+def in_subtree(path, subpath):
+    return not subpath or path == subpath or path.startswith(subpath + '/')
+
+
+worker_collection = None
+
+
+def init_worker(snapshots, music_root):
+    global worker_collection
+    worker_collection = Collection(snapshots, music_root, need_update=False)
+    # forked workers start with a copy of the parent's metrics and verification counts
+    metrics.reset()
+    worker_collection.snapshots.verification_stats.take()
+
+
+def worker_read_file(path):
+    return worker_collection.read_file(path), metrics.take(), worker_collection.snapshots.verification_stats.take()
+
+
+class ApplyReport:
+    def __init__(self, changeset):
+        self.moved = len(changeset.moved)
+        self.retagged = len(changeset.retagged)
+        self.moved_and_retagged = len(changeset.moved_and_retagged)
+        self.unchanged = len(changeset.unchanged)
+        self.duplicates = sum(changeset.duplicates.values())
+        self.rewrite_bytes_avoided = 0
+
+    def __str__(self):
+        return (
+            f'moved: {self.moved}, retagged: {self.retagged}, moved and retagged: {self.moved_and_retagged}, '
+            f'unchanged: {self.unchanged}, duplicates: {self.duplicates}, '
+            f'rewrite bytes avoided: {self.rewrite_bytes_avoided}'
+        )
+
+
+def tags_equal(lhs, rhs):
+    return sorted(lhs) == sorted(rhs)
+
+
 class Collection:
-    def __init__(self, snapshots: Snapshots, music_root, expected_cs=None, need_update=True):
+    def __init__(self, snapshots: Snapshots, music_root, expected_cs=None, need_update=True, jobs=1, progress=None):
         if expected_cs is None:
             expected_cs = []
 
         self.snapshots = snapshots
         self.music_root = music_root
+        self.jobs = jobs
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.picture_refs = None
+        self.scan_index = ScanIndex(posixpath.join(snapshots.snapshot_root, 'scan_index.sqlite'))
+        self.backup_dir = posixpath.join(snapshots.snapshot_root, 'tag_backups')
         self.state = None
         self.by_path = None
         self.set_state(expected_cs)
@@ -43,6 +137,33 @@ class Collection:
     def set_state(self, state):
         self.state = state
         self.by_path = dict((fs['path'], fs) for fs in state)
+        self.picture_refs = Counter()
+        for fs in state:
+            self.picture_refs.update(self.record_pictures(fs))
+
+    def merge_subtree(self, subpath, cs):
+        # replaces the records under subpath and keeps the rest of the state
+        if not subpath:
+            self.set_state(cs)
+            return
+        state = []
+        with self.lock:
+            for fs in self.state:
+                if in_subtree(fs['path'], subpath):
+                    self.picture_refs.subtract(self.record_pictures(fs))
+                    del self.by_path[fs['path']]
+                else:
+                    state.append(fs)
+            for fs in cs:
+                self.picture_refs.update(self.record_pictures(fs))
+                self.by_path[fs['path']] = fs
+        self.state = state + cs
+
+    def record_pictures(self, fs):
+        for frame_snapshot in fs['tags']:
+            if frame_snapshot.startswith('APIC('):
+                name, kwargs = self.snapshots.parse_frame_snapshot(frame_snapshot)
+                yield kwargs['path']
 
     def real_path(self, path):
         return posixpath.join(self.music_root, path)
@@ -53,23 +174,42 @@ class Collection:
 
     def delete_empty_folders(self, path):
         real_path = self.real_path(path)
-        if posixpath.isfile(real_path):
+        if not posixpath.isdir(real_path):
             return
         for f in os.listdir(real_path):
             self.delete_empty_folders(posixpath.join(path, f))
         if len(os.listdir(real_path)) == 0:
             os.rmdir(real_path)
 
-    def music_search(self, path, res):
+    def list_dir(self, path):
         real_path = self.real_path(path)
-        if posixpath.isfile(real_path):
+        stat = os.stat(real_path)
+        entries = self.scan_index.get_dir(real_path, stat)
+        if entries is None:
+            with os.scandir(real_path) as it:
+                entries = sorted((entry.name, entry.is_dir()) for entry in it)
+            self.scan_index.put_dir(real_path, stat, entries)
+        return entries
+
+    def music_search(self, path, res, dirs=None):
+        real_path = self.real_path(path)
+        if path and posixpath.isfile(real_path):
             if real_path.endswith('.mp3'):
                 res.append(path)
             else:
                 print('Bad extension:', real_path)
             return
-        for f in sorted(os.listdir(real_path)):
-            self.music_search(posixpath.join(path, f), res)
+        if dirs is not None:
+            dirs.append(path)
+        for name, is_dir in self.list_dir(path):
+            child = posixpath.join(path, name)
+            if is_dir:
+                self.music_search(child, res, dirs)
+            elif name.endswith('.mp3'):
+                res.append(child)
+            elif not is_copy_temp(name):
+                # temps of copy writes belong to a running apply or are removed when an interrupted one is resumed
+                print('Bad extension:', self.real_path(child))
 
     def read_file(self, path):
         real_path = self.real_path(path)
@@ -77,24 +217,122 @@ class Collection:
         fs['path'] = path
         fs['modified'] = modified_timestamp(real_path)
         fs['hash'] = get_mp3_hash(real_path)
-        fs['tags'] = self.snapshots.serialize_tags(ID3(real_path))
+        with metrics.phase('tag_parse'):
+            tags = ID3(real_path)
+        with metrics.phase('serialize'):
+            fs['tags'] = self.snapshots.serialize_tags(tags)
+        metrics.count('files_hashed')
         return fs
 
-    def load_fs(self, path):
-        if path in self.by_path:
-            fs = self.by_path[path]
-            if fs['modified'] == modified_timestamp(self.real_path(path)):
-                return deepcopy(fs)
-        return self.read_file(path)
+    def load_cached(self, path, stat):
+        cached = self.scan_index.get(self.real_path(path), stat)
+        if cached is None:
+            return None
+        fs = OrderedDict()
+        fs['path'] = path
+        fs['modified'] = int(stat.st_mtime)
+        fs['hash'], fs['tags'] = cached
+        return fs
 
-    def update(self):
+    def remember(self, fs, stat=None):
+        real_path = self.real_path(fs['path'])
+        if stat is None:
+            stat = os.stat(real_path)
+            fs['modified'] = int(stat.st_mtime)
+        self.scan_index.put(real_path, stat, fs['hash'], fs['tags'])
+
+    def refresh(self, paths, failed=None):
+        # re-reads the given files only, dropping the records of files that no longer exist;
+        # with a failed list, files that cannot be read keep their records and are collected there
+        changed = 0
+        for path in paths:
+            if not path.endswith('.mp3'):
+                continue
+            real_path = self.real_path(path)
+            fs = None
+            if posixpath.isfile(real_path):
+                try:
+                    fs = self.read_file(path)
+                except Exception as ex:
+                    if failed is None:
+                        raise ex
+                    failed.append((path, ex))
+                    continue
+                self.remember(fs)
+            else:
+                self.scan_index.remove(real_path)
+            old_fs = self.by_path.get(path)
+            if old_fs == fs:
+                continue
+            with self.lock:
+                if old_fs is not None:
+                    self.picture_refs.subtract(self.record_pictures(old_fs))
+                    del self.by_path[path]
+                if fs is not None:
+                    self.picture_refs.update(self.record_pictures(fs))
+                    self.by_path[path] = fs
+            changed += 1
+        if changed:
+            self.state = list(self.by_path.values())
+        return changed
+
+    def read_files(self, paths):
+        if self.jobs <= 1 or len(paths) <= 1:
+            return map(self.read_file, paths)
+        return self.read_files_parallel(paths)
+
+    def read_files_parallel(self, paths):
+        executor = ProcessPoolExecutor(
+            max_workers=self.jobs,
+            initializer=init_worker,
+            initargs=(self.snapshots, self.music_root),
+        )
+        chunksize = max(1, min(64, len(paths) // (4 * self.jobs)))
+        with executor:
+            for fs, worker_metrics, worker_verification in executor.map(worker_read_file, paths, chunksize=chunksize):
+                metrics.merge(worker_metrics)
+                self.snapshots.verification_stats.merge(worker_verification)
+                yield fs
+
+    @metrics.timed('update')
+    def update(self, writer=None, progress=None, subpath=''):
+        if progress is None:
+            progress = self.progress
+        for event in self.iter_update(writer, subpath):
+            if progress is not None:
+                progress(event)
+
+    def iter_update(self, writer=None, subpath=''):
+        # with a subpath only that file or folder is scanned and merged into the current state
+        subpath = subpath.strip('/')
         files = []
-        self.music_search('', files)
-        cs = []
-        for num, path in enumerate(files):
-            print("%d/%d" % (num + 1, len(files)), path)
-            cs.append(self.load_fs(path))
-        self.set_state(cs)
+        dirs = []
+        with metrics.phase('walk'):
+            if posixpath.exists(self.real_path(subpath)):
+                self.music_search(subpath, files, dirs)
+        with metrics.phase('stat'):
+            stats = [os.stat(self.real_path(path)) for path in files]
+            cs = [self.load_cached(path, stat) for path, stat in zip(files, stats)]
+        todo = [path for path, fs in zip(files, cs) if fs is None]
+        metrics.count('files_reused', len(files) - len(todo))
+        results = iter(self.read_files(todo))
+        with self.scan_index.batch():
+            for num, path in enumerate(files):
+                yield ProgressEvent(file_started, path, num, len(files), stats[num].st_size)
+                kind = file_reused
+                if cs[num] is None:
+                    cs[num] = next(results)
+                    self.remember(cs[num], stats[num])
+                    kind = file_hashed
+                if writer is not None:
+                    writer.write(cs[num])
+                yield ProgressEvent(kind, path, num, len(files), stats[num].st_size)
+            if writer is not None and subpath:
+                for fs in self.state:
+                    if not in_subtree(fs['path'], subpath):
+                        writer.write(fs)
+            self.scan_index.retain(self.real_path(subpath), map(self.real_path, files), map(self.real_path, dirs))
+        self.merge_subtree(subpath, cs)
 
     def move_file(self, cur_path, new_path):
         if new_path == cur_path:
@@ -105,87 +343,161 @@ class Collection:
         os.makedirs(posixpath.dirname(new_real_path), exist_ok=True)
         fs = self.by_path[cur_path]
         shutil.move(cur_real_path, new_real_path)
+        self.scan_index.remove(cur_real_path)
         del self.by_path[cur_path]
         fs['path'] = new_path
-        fs['modified'] = modified_timestamp(new_real_path)
+        self.remember(fs)
         self.by_path[new_path] = fs
+        metrics.count('files_moved')
 
+    def check_tags(self, real_path, serialized_tags):
+        result_tags = self.snapshots.serialize_tags(ID3(real_path))
+        assert (
+            sorted(serialized_tags) ==
+            sorted(result_tags)
+        )
+
+    @metrics.timed('write_tags')
     def set_tags(self, path, serialized_tags):
         tags = self.snapshots.deserialize_tags(serialized_tags)
         serialized_tags = self.snapshots.serialize_tags(tags)
-        temp = uuid.uuid4().hex + '.mp3'
         real_path = self.real_path(path)
-        real_temp = self.real_path(temp)
-        shutil.copy2(real_path, real_temp)
-        try:
-            tags.save(real_temp)
-            result_tags = self.snapshots.serialize_tags(ID3(real_temp))
-            assert (
-                sorted(serialized_tags) ==
-                sorted(result_tags)
-            )
-        except Exception as ex:
-            os.remove(real_temp)
-            raise ex
-        os.remove(real_path)
+        backup = save_in_place(tags, real_path, self.backup_dir)
+        if backup:
+            try:
+                self.check_tags(real_path, serialized_tags)
+            except Exception as ex:
+                restore_backup(backup)
+                raise ex
+            os.remove(backup)
+            metrics.count('tags_written_in_place')
+        else:
+            real_temp = save_by_copy(tags, real_path)
+            try:
+                self.check_tags(real_temp, serialized_tags)
+            except Exception as ex:
+                os.remove(real_temp)
+                raise ex
+            os.replace(real_temp, real_path)
+            metrics.count('tags_written_by_copy')
         fs = self.by_path[path]
-        shutil.move(real_temp, real_path)
-        fs['modified'] = modified_timestamp(real_path)
-        fs['tags'] = serialized_tags
-
-    def apply_snapshot(self, new_cs):
+        with self.lock:
+            self.picture_refs.subtract(self.record_pictures(fs))
+            fs['tags'] = serialized_tags
+            self.picture_refs.update(self.record_pictures(fs))
+        self.remember(fs)
+
+    def journaled(self, journal, op_id, action, *args):
+        journal.started(op_id)
+        action(*args)
+        journal.done(op_id)
+
+    def move_chain(self, journal, chain):
+        for op_id, cur_path, new_path in chain:
+            self.journaled(journal, op_id, self.move_file, cur_path, new_path)
+
+    def resume_apply(self):
+        journal = ApplyJournal(self.snapshots, self.music_root)
+        if not journal.matches():
+            return None
+        subpath = journal.subpath()
+        changed_cs = journal.changes()
+        touched = journal.touched_paths()
+        # backups and copy temps can only be left by the interrupted apply, while a scan may run
+        # next to another process that is writing tags, so they are recovered here and not in update
+        restore_backups(self.backup_dir)
+        in_flight_paths = journal.in_flight_paths()
+        for real_dir in sorted(set(posixpath.dirname(self.real_path(path)) for path in in_flight_paths)):
+            remove_copy_temps(real_dir)
+        # files touched by unfinished operations may be torn, so they are always rescanned
+        for path in in_flight_paths:
+            self.scan_index.remove(self.real_path(path))
+        self.update()
+        # the target is the current state with the journaled records put in place of whatever
+        # the interrupted apply left at their paths
+        target_cs = [
+            fs for fs in self.state if fs['path'] not in touched and in_subtree(fs['path'], subpath)
+        ] + changed_cs
+        return self.apply_snapshot(target_cs, subpath=subpath, touched=touched)
+
+    def subtree_records(self, new_cs, subpath, touched=()):
+        # target records outside the subtree must either be identical to the current record at
+        # that path, which is left alone, or take a file from the subtree to a free path;
+        # touched paths of an interrupted apply count as part of the subtree
+        cur_cs = [fs for fs in self.state if in_subtree(fs['path'], subpath) or fs['path'] in touched]
+        subtree_hashes = set(fs['hash'] for fs in cur_cs)
+        new_cs_in_subtree = []
+        outside_changes = []
+        for fs in new_cs:
+            if in_subtree(fs['path'], subpath) or fs['path'] in touched:
+                new_cs_in_subtree.append(fs)
+                continue
+            cur_fs = self.by_path.get(fs['path'])
+            if cur_fs is None:
+                if fs['hash'] in subtree_hashes:
+                    new_cs_in_subtree.append(fs)
+                else:
+                    outside_changes.append(fs['path'])
+            elif cur_fs['hash'] != fs['hash'] or not (
+                cur_fs['tags'] == fs['tags'] or tags_equal(cur_fs['tags'], fs['tags'])
+            ):
+                outside_changes.append(fs['path'])
+        if outside_changes:
+            raise SubtreeMismatchError(subpath, sorted(outside_changes))
+        return cur_cs, new_cs_in_subtree
+
+    @metrics.timed('apply')
+    def apply_snapshot(self, new_cs, jobs=None, subpath='', touched=()):
+        if jobs is None:
+            jobs = self.jobs
+        subpath = subpath.strip('/')
         cur_cs = self.state
+        if subpath:
+            cur_cs, new_cs = self.subtree_records(new_cs, subpath, touched)
 
         assert len(set(fs['path'] for fs in new_cs)) == len(new_cs)
         for fs in new_cs:
             assert self.is_good_path(fs['path'])
 
-        untouched = set(map(repr, cur_cs)) & set(map(repr, new_cs))
-        cur_cs = filter(lambda fs: repr(fs) not in untouched, cur_cs)
-        new_cs = filter(lambda fs: repr(fs) not in untouched, new_cs)
-
-        cur_cs = sorted(cur_cs, key=lambda fs: fs['hash'])
-        new_cs = sorted(new_cs, key=lambda fs: fs['hash'])
-        assert len(cur_cs) == len(new_cs)
-        for cur_fs, new_fs in zip(cur_cs, new_cs):
-            assert cur_fs['hash'] == new_fs['hash']
-
-        if len(cur_cs) == 0:
-            return
-
-        cur_cs, new_cs = zip(*sorted(zip(cur_cs, new_cs), key=lambda pair: pair[0]['path']))
-
-        todo = dict((fs['path'], i) for i, fs in enumerate(cur_cs))
-
-        def rec(path, first=False):
-            if path not in todo:
-                return
-            i = todo[path]
-            del todo[path]
-            if first:
-                temp = uuid.uuid4().hex + '.mp3'
-                self.move_file(path, temp)
-                path = temp
-            to = new_cs[i]['path']
-            rec(to)
-
-            self.move_file(path, to)
-            self.set_tags(to, new_cs[i]['tags'])
-
-        for cur_fs in cur_cs:
-            rec(cur_fs['path'], True)
-
-        self.delete_empty_folders('')
+        changeset = diff_snapshots(cur_cs, new_cs)
+        report = ApplyReport(changeset)
+        for cur_fs, new_fs in changeset.moved:
+            report.rewrite_bytes_avoided += os.path.getsize(self.real_path(cur_fs['path']))
+        pairs = sorted(changeset.changed(), key=lambda pair: pair[0]['path'])
+        if len(pairs) == 0:
+            return report
+        cur_cs, new_cs = zip(*pairs)
+        retag = [not tags_equal(cur_fs['tags'], new_fs['tags']) for cur_fs, new_fs in pairs]
+
+        journal = ApplyJournal(self.snapshots, self.music_root)
+        journal.begin([fs['path'] for fs in cur_cs], list(new_cs), subpath)
+        chains = [
+            [(journal.plan('move', cur_path, new_path), cur_path, new_path) for cur_path, new_path in chain]
+            for chain in build_move_chains([fs['path'] for fs in cur_cs], [fs['path'] for fs in new_cs])
+        ]
+        retags = [
+            (journal.plan('tags', new_fs['path']), new_fs['path'], new_fs['tags'])
+            for new_fs, need_retag in zip(new_cs, retag) if need_retag
+        ]
+        journal.sync()
+
+        run_tasks([partial(self.move_chain, journal, chain) for chain in chains], jobs)
+        run_tasks([
+            partial(self.journaled, journal, op_id, self.set_tags, path, tags)
+            for op_id, path, tags in retags
+        ], jobs)
+
+        self.delete_empty_folders(subpath)
+        journal.finish()
+        return report
 
     def get_used_pictures(self):
-        used_pictures = []
-        for fs in self.state:
-            for frame_snapshot in fs['tags']:
-                name, kwargs = self.snapshots.parse_frame_snapshot(frame_snapshot)
-                if name == 'APIC':
-                    used_pictures.append(kwargs['path'])
-        return used_pictures
-
-    def remove_unused_pictures(self):
-        used_picrures = self.get_used_pictures()
-        self.snapshots.filter_pictures(lambda name: name in used_picrures)
+        return set(name for name, count in self.picture_refs.items() if count > 0)
+
+    @metrics.timed('gc')
+    def remove_unused_pictures(self, dry_run=False):
+        unused = sorted(self.snapshots.pictures.names - self.get_used_pictures())
+        if not dry_run:
+            self.snapshots.remove_pictures(unused)
+            metrics.count('pictures_removed', len(unused))
+        return unused
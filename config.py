@@ -1,2 +1,3 @@
 music_root = 'C:/Users/vmokin/Music/'
 snapshot_root = 'C:/Users/vmokin/Programming/MusicTagsSnapshot'
+snapshot_name = 'data.json'
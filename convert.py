@@ -0,0 +1,13 @@
+import argparse
+
+from config import snapshot_root
+from snapshots import Snapshots
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a snapshot between formats, chosen by file extension')
+    parser.add_argument('src', help='snapshot name in the snapshot root, e.g. data.json')
+    parser.add_argument('dst', help='snapshot name in the snapshot root, e.g. data.jsonl')
+    args = parser.parse_args()
+
+    Snapshots(snapshot_root).convert(args.src, args.dst)
@@ -0,0 +1,53 @@
+import os
+import json
+import uuid
+import hashlib
+import posixpath
+
+
+def fingerprint(fs):
+    data = json.dumps([fs['path'], sorted(fs['tags'])], ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+class FixState:
+    # results of the previous autofix run by the fingerprint of the input record;
+    # None means the record was already fixed
+    def __init__(self, snapshots, rules_version, name='autofix_state.json'):
+        self.path = posixpath.join(snapshots.snapshot_root, name)
+        self.rules_version = rules_version
+        self.results = {}
+        self.used = {}
+        self.reused = 0
+        self.fixed = 0
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        if state.get('rules_version') == self.rules_version:
+            self.results = state['results']
+
+    def save(self):
+        # only the records seen in this run are kept
+        temp = self.path + '.' + uuid.uuid4().hex + '.tmp'
+        with open(temp, 'w', encoding='utf8', newline='\n') as f:
+            json.dump({'rules_version': self.rules_version, 'results': self.used}, f, ensure_ascii=False)
+        os.replace(temp, self.path)
+
+    def lookup(self, key):
+        if key not in self.results:
+            return False, None
+        result = self.used[key] = self.results[key]
+        self.reused += 1
+        return True, result
+
+    def store(self, key, fs, result_fs):
+        if fs['path'] == result_fs['path'] and fs['tags'] == result_fs['tags']:
+            result = None
+        else:
+            result = [result_fs['path'], result_fs['tags']]
+        self.results[key] = self.used[key] = result
+        self.fixed += 1
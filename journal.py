@@ -0,0 +1,116 @@
+import os
+import json
+import shutil
+import posixpath
+import threading
+
+
+class ApplyJournal:
+    def __init__(self, snapshots, music_root):
+        self.snapshots = snapshots
+        self.music_root = music_root
+        self.name = 'apply_journal'
+        self.dir = posixpath.join(snapshots.snapshot_root, self.name)
+        self.ops_path = posixpath.join(self.dir, 'ops.jsonl')
+        self.changes_name = posixpath.join(self.name, 'changes.json')
+        self.lock = threading.Lock()
+        self.file = None
+        self.next_id = 0
+
+    def exists(self):
+        return posixpath.isfile(self.ops_path)
+
+    def write(self, entry, sync=False):
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def begin(self, sources, changed_cs, subpath=''):
+        # only the changed records are kept: the paths they come from and the records they become
+        self.discard()
+        os.makedirs(self.dir, exist_ok=True)
+        self.snapshots.save(changed_cs, self.changes_name, sort=False)
+        self.file = open(self.ops_path, 'w', encoding='utf8', newline='\n')
+        self.next_id = 0
+        self.write({'music_root': self.music_root, 'subpath': subpath, 'sources': sources}, sync=True)
+
+    def plan(self, kind, *paths):
+        op_id = self.next_id
+        self.next_id += 1
+        self.write({'op': op_id, 'kind': kind, 'paths': paths})
+        return op_id
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+
+    def started(self, op_id):
+        self.write({'started': op_id})
+
+    def done(self, op_id):
+        self.write({'done': op_id})
+
+    def finish(self):
+        self.file.close()
+        self.file = None
+        self.discard()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if posixpath.isdir(self.dir):
+            shutil.rmtree(self.dir)
+
+    def read(self):
+        header = None
+        ops = {}
+        started = set()
+        done = set()
+        with open(self.ops_path, 'r', encoding='utf8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be torn by the crash
+                    break
+                if 'music_root' in entry:
+                    header = entry
+                elif 'op' in entry:
+                    ops[entry['op']] = entry
+                elif 'started' in entry:
+                    started.add(entry['started'])
+                elif 'done' in entry:
+                    done.add(entry['done'])
+        return header, ops, started, done
+
+    def in_flight_paths(self):
+        header, ops, started, done = self.read()
+        paths = []
+        for op_id in sorted(started - done):
+            paths.extend(ops[op_id]['paths'])
+        return paths
+
+    def touched_paths(self):
+        # every path an operation may have left a file at, including temp paths of move cycles
+        header, ops, started, done = self.read()
+        paths = set(header['sources'])
+        for op in ops.values():
+            paths.update(op['paths'])
+        paths.update(fs['path'] for fs in self.changes())
+        return paths
+
+    def matches(self):
+        if not self.exists():
+            return False
+        header = self.read()[0]
+        # journals that kept a whole target snapshot instead of the changes have no sources
+        return header is not None and header['music_root'] == self.music_root and 'sources' in header
+
+    def subpath(self):
+        return self.read()[0].get('subpath', '')
+
+    def changes(self):
+        return self.snapshots.load(self.changes_name)
@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import time
+import uuid
+import posixpath
+import threading
+from collections import Counter
+from functools import wraps
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def plain(value):
+    # cache_info() results are named tuples
+    if hasattr(value, '_asdict'):
+        return value._asdict()
+    if isinstance(value, dict):
+        return dict((key, plain(item)) for key, item in value.items())
+    return value
+
+
+def peak_memory():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+class Metrics:
+    # phase times are summed over threads and processes, so nested and parallel phases can add up
+    # to more than the wall time of the run
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.reset()
+
+    def reset(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.counters = Counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        def decorator(f):
+            @wraps(f)
+            def with_timing(*args, **kwargs):
+                with self.phase(name):
+                    return f(*args, **kwargs)
+            return with_timing
+        return decorator
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def take(self):
+        # metrics collected by a worker process since the last call, to be merged by the parent
+        with self.lock:
+            data = {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+            self.reset()
+        return data
+
+    def merge(self, data):
+        with self.lock:
+            self.seconds.update(data['seconds'])
+            self.calls.update(data['calls'])
+            self.counters.update(data['counters'])
+
+    def report(self, **extra):
+        with self.lock:
+            phases = dict(
+                (name, {'seconds': self.seconds[name], 'calls': self.calls[name]})
+                for name in sorted(self.seconds)
+            )
+            counters = dict(sorted(self.counters.items()))
+        return dict({
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': time.time() - self.started,
+            'phases': phases,
+            'counters': counters,
+            'peak_memory': peak_memory(),
+        }, **plain(extra))
+
+    def save(self, path, **extra):
+        os.makedirs(posixpath.dirname(path) or '.', exist_ok=True)
+        temp = path + '.' + uuid.uuid4().hex + '.tmp'
+        with open(temp, 'w', encoding='utf8', newline='\n') as f:
+            json.dump(self.report(**extra), f, indent=4, default=str)
+        os.replace(temp, path)
+
+
+def report_path(snapshot_root, name):
+    return posixpath.join(snapshot_root, 'metrics', '%s-%s.json' % (name, time.strftime('%Y%m%d-%H%M%S')))
+
+
+metrics = Metrics()
@@ -2,7 +2,7 @@ from simple_tags import SimpleTags
 
 
 class MyTags(SimpleTags):
-    pass
+    __slots__ = ()
 
 
 MyTags.clear_storage()
@@ -0,0 +1,163 @@
+import os
+import uuid
+import posixpath
+import threading
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+shard_length = 2
+
+
+class PictureStore:
+    # pictures are named by the MD5 of their data and sharded into subdirectories by the first hex digits
+    def __init__(self, root, cache_bytes=64 << 20):
+        self.root = root
+        self._names = None
+        self.cache_bytes = cache_bytes
+        self.lock = threading.Lock()
+        self.clear_cache()
+        os.makedirs(root, exist_ok=True)
+        # done here rather than on first use, so that scanning processes never migrate the same files at once
+        self.migrate()
+
+    def __getstate__(self):
+        return {'root': self.root, '_names': self._names, 'cache_bytes': self.cache_bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.clear_cache()
+
+    def clear_cache(self):
+        # decoded pictures by name, least recently used first
+        self.cache = OrderedDict()
+        self.cache_by_size = {}
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hash_skips = 0
+
+    def cache_info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hash_skips': self.hash_skips,
+            'pictures': len(self.cache),
+            'bytes': self.cached_bytes,
+        }
+
+    def remember(self, name, data):
+        if len(data) > self.cache_bytes:
+            return
+        with self.lock:
+            if name in self.cache:
+                self.cache.move_to_end(name)
+                return
+            self.cache[name] = data
+            self.cache_by_size.setdefault(len(data), []).append(name)
+            self.cached_bytes += len(data)
+            while self.cached_bytes > self.cache_bytes:
+                self.forget(next(iter(self.cache)))
+
+    def forget(self, name):
+        data = self.cache.pop(name, None)
+        if data is None:
+            return
+        names = self.cache_by_size[len(data)]
+        names.remove(name)
+        if not names:
+            del self.cache_by_size[len(data)]
+        self.cached_bytes -= len(data)
+
+    def find(self, data, extension):
+        # a byte comparison with a cached picture is much cheaper than hashing the data again
+        with self.lock:
+            for name in self.cache_by_size.get(len(data), ()):
+                if name.endswith(extension) and self.cache[name] == data:
+                    self.cache.move_to_end(name)
+                    self.hash_skips += 1
+                    return name
+        return None
+
+    def path(self, name):
+        return posixpath.join(self.root, name[:shard_length], name)
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = self.load_names()
+        return self._names
+
+    def migrate(self):
+        # pictures stored before sharding was introduced
+        with os.scandir(self.root) as it:
+            flat = [entry for entry in it if not entry.name.endswith('.tmp') and not entry.is_dir()]
+        for entry in flat:
+            os.makedirs(posixpath.dirname(self.path(entry.name)), exist_ok=True)
+            try:
+                os.replace(entry.path, self.path(entry.name))
+            except FileNotFoundError:
+                # already moved by another process
+                pass
+
+    def load_names(self):
+        names = set()
+        with os.scandir(self.root) as it:
+            shards = [entry.path for entry in it if entry.is_dir()]
+        for shard in shards:
+            with os.scandir(shard) as it:
+                names.update(entry.name for entry in it if not entry.name.endswith('.tmp'))
+        return names
+
+    def reload(self):
+        # for long-running processes: other processes may have added or removed pictures
+        self._names = None
+        with self.lock:
+            self.clear_cache()
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def put(self, name, data):
+        self.remember(name, data)
+        if name in self.names:
+            return
+        path = self.path(name)
+        shard = posixpath.dirname(path)
+        os.makedirs(shard, exist_ok=True)
+        # several scanning processes may store the same picture at once
+        temp = posixpath.join(shard, uuid.uuid4().hex + '.tmp')
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        self.names.add(name)
+        metrics.count('pictures_written')
+        metrics.count('picture_bytes_written', len(data))
+
+    def get(self, name):
+        with self.lock:
+            data = self.cache.get(name)
+            if data is not None:
+                self.cache.move_to_end(name)
+                self.hits += 1
+                return data
+            self.misses += 1
+        with open(self.path(name), 'rb') as f:
+            data = f.read()
+        self.remember(name, data)
+        return data
+
+    def remove(self, name):
+        os.remove(self.path(name))
+        self.names.discard(name)
+        with self.lock:
+            self.forget(name)
+
+    def remove_empty_shards(self):
+        with os.scandir(self.root) as it:
+            shards = [entry.path for entry in it if entry.is_dir()]
+        for shard in shards:
+            if not os.listdir(shard):
+                os.rmdir(shard)
@@ -0,0 +1,57 @@
+import sys
+import time
+from collections import namedtuple, Counter
+
+
+file_started = 'started'
+file_reused = 'reused'
+file_hashed = 'hashed'
+
+ProgressEvent = namedtuple('ProgressEvent', ['kind', 'path', 'index', 'total', 'size'])
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ConsoleProgress:
+    # prints at most one line per interval and always the last one
+    def __init__(self, interval=1.0, stream=None, clock=time.monotonic):
+        self.interval = interval
+        self.stream = stream
+        self.clock = clock
+        self.started = None
+        self.last = None
+        self.counts = Counter()
+        self.bytes_hashed = 0
+
+    def __call__(self, event):
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+        if event.kind == file_started:
+            return
+        self.counts[event.kind] += 1
+        if event.kind == file_hashed:
+            self.bytes_hashed += event.size
+        done = event.index + 1
+        if done < event.total and self.last is not None and now - self.last < self.interval:
+            return
+        self.last = now
+        print(self.format(event, now), file=self.stream or sys.stdout)
+
+    def format(self, event, now):
+        done = event.index + 1
+        elapsed = max(now - self.started, 1e-6)
+        rate = done / elapsed
+        return '%d/%d files (%d reused, %d hashed)  %.1f files/s  %.1f MB/s  ETA %s  %s' % (
+            done,
+            event.total,
+            self.counts[file_reused],
+            self.counts[file_hashed],
+            rate,
+            self.bytes_hashed / elapsed / (1 << 20),
+            format_duration((event.total - done) / rate),
+            event.path,
+        )
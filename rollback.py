@@ -1,12 +1,39 @@
-from config import snapshot_root, music_root
+import argparse
+
+from config import snapshot_root, music_root, snapshot_name
 from collection import Snapshots, Collection
+from snapshots import verify_levels, verify_full
+from metrics import metrics, report_path
+from progress import ConsoleProgress
+import snapshot_parser
 
 
 if __name__ == '__main__':
-    snapshots = Snapshots(snapshot_root)
-    cs = snapshots.load('data.json')
-    collection = Collection(snapshots, music_root, expected_cs=cs)
-    collection.apply_snapshot(cs)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='number of scanning processes and apply threads')
+    parser.add_argument('--verify', choices=verify_levels, default=verify_full, help='serialization check level')
+    parser.add_argument('--subpath', default='', help='only scan and apply this file or folder of the music root')
+    parser.add_argument('--metrics', help='where to write the metrics report of the run')
+    args = parser.parse_args()
+
+    snapshots = Snapshots(snapshot_root, verify=args.verify)
+    cs = snapshots.load(snapshot_name)
+    collection = Collection(
+        snapshots, music_root, expected_cs=cs, need_update=False, jobs=args.jobs, progress=ConsoleProgress()
+    )
+    resumed = collection.resume_apply()
+    if resumed is None:
+        collection.update(subpath=args.subpath)
+    else:
+        print('Resumed interrupted apply:', resumed)
+    print(collection.apply_snapshot(cs, subpath=args.subpath))
     cs = collection.state
-    snapshots.save(cs, 'data.json')
+    snapshots.save(cs, snapshot_name)
     collection.remove_unused_pictures()
+
+    metrics.save(
+        args.metrics or report_path(snapshot_root, 'rollback'),
+        verification=snapshots.verification_stats.as_dict(),
+        snapshot_parser=snapshot_parser.cache_info(),
+        pictures=snapshots.pictures.cache_info(),
+    )
@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# directory listings modified this recently may still change within the same mtime tick
+racy_interval_ns = 2 * 10 ** 9
+
+
+def index_key(real_path):
+    return os.path.abspath(real_path)
+
+
+class ScanIndex:
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self.lock = threading.RLock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT, tags TEXT)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, inode INTEGER, entries TEXT)'
+            )
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                yield
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def get(self, real_path, stat):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT hash, tags FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?',
+                (index_key(real_path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put(self, real_path, stat, hash, tags):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, hash, tags) VALUES (?, ?, ?, ?, ?, ?)',
+                (index_key(real_path), stat.st_size, stat.st_mtime_ns, stat.st_ino, hash,
+                 json.dumps(tags, ensure_ascii=False))
+            )
+
+    def remove(self, real_path):
+        with self.lock:
+            self.connection.execute('DELETE FROM files WHERE path = ?', (index_key(real_path),))
+
+    def get_dir(self, real_path, stat):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT entries FROM dirs WHERE path = ? AND mtime_ns = ? AND inode = ?',
+                (index_key(real_path), stat.st_mtime_ns, stat.st_ino)
+            ).fetchone()
+        if row is None:
+            return None
+        return [tuple(entry) for entry in json.loads(row[0])]
+
+    def put_dir(self, real_path, stat, entries):
+        if time.time_ns() - stat.st_mtime_ns < racy_interval_ns:
+            return
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO dirs (path, mtime_ns, inode, entries) VALUES (?, ?, ?, ?)',
+                (index_key(real_path), stat.st_mtime_ns, stat.st_ino, json.dumps(entries, ensure_ascii=False))
+            )
+
+    def _retain(self, table, root, keep):
+        rows = self.connection.execute(
+            f'SELECT path FROM {table} WHERE substr(path, 1, ?) = ?', (len(root), root)
+        ).fetchall()
+        stale = [(path,) for path, in rows if path not in keep]
+        self.connection.executemany(f'DELETE FROM {table} WHERE path = ?', stale)
+
+    def retain(self, real_root, real_paths, real_dirs=()):
+        # real_root may also be a single file
+        root = index_key(real_root)
+        prefix = os.path.join(root, '')
+        keep = set(map(index_key, real_paths))
+        with self.lock:
+            if root not in keep:
+                self.connection.execute('DELETE FROM files WHERE path = ?', (root,))
+            self._retain('files', prefix, keep)
+            self._retain('dirs', prefix, set(map(index_key, real_dirs)))
@@ -5,6 +5,7 @@ from typing import Any, List, Mapping, Optional
 class FieldProto:
     def __init__(self, frame, desc=None, multifield=False):
         self.name = None
+        self.index = None
         self.frame = frame
         self.desc = desc
         self.multifield = multifield
@@ -17,6 +18,28 @@ class FieldProto:
     def key(self):
         return self.frame, self.desc
 
+    def default(self):
+        return [] if self.multifield else ''
+
+    def check(self, value):
+        if self.multifield:
+            if not isinstance(value, list):
+                raise TypeError()
+            for s in value:
+                if not isinstance(s, str):
+                    raise TypeError()
+        else:
+            if not isinstance(value, str):
+                raise TypeError()
+
+    def decode(self, kwargs):
+        if self.frame == 'APIC':
+            return kwargs['path']
+        value = kwargs['text']
+        if self.frame != 'USLT' and not self.multifield:
+            value = value[0]
+        return value
+
 
 class FieldStorage:
     class FieldStorageFinalizeError(Exception):
@@ -34,6 +57,11 @@ class FieldStorage:
         self.fields: List[FieldProto] = []
         self.by_key: Mapping[Any, FieldProto] = OrderedDict()
         self.is_finalized = False
+        self.layout: List[FieldProto] = []
+        self.defaults: List[Any] = []
+        self.multifield_indices: List[int] = []
+        self.decoders: Mapping[str, Mapping[Optional[str], FieldProto]] = {}
+        self.path_index: Optional[int] = None
 
     def add(self, *args, **kwargs):
         if self.is_finalized:
@@ -56,9 +84,38 @@ class FieldStorage:
                 raise self.FieldStorageFinalizeError(field, names)
             field.set_name(names[0])
             self.by_key[field.key()] = field
+        self.compile()
+
+    def compile(self):
+        # values of a record are stored in a list indexed by field; frames are decoded by a table
+        # keyed by frame name and description
+        self.layout = list(self.by_key.values())
+        for index, field in enumerate(self.layout):
+            field.index = index
+            if field.frame == 'PATH':
+                self.path_index = index
+            else:
+                self.decoders.setdefault(field.frame, {})[field.desc] = field
+        for field in self.fields:
+            field.index = self.by_key[field.key()].index
+        self.defaults = [field.default() for field in self.layout]
+        self.multifield_indices = [field.index for field in self.layout if field.multifield]
+
+    def index(self, field):
+        if field.index is not None:
+            return field.index
+        return self.by_key[field.key()].index
+
+    def new_values(self):
+        values = self.defaults.copy()
+        for index in self.multifield_indices:
+            values[index] = []
+        return values
 
 
 class SimpleTags:
+    __slots__ = ('snapshots', 'values')
+
     _field_storage: Optional[FieldStorage] = None
 
     @classmethod
@@ -74,70 +131,51 @@ class SimpleTags:
         cls._field_storage.finalize(variables)
 
     def __getitem__(self, item: FieldProto):
-        return self.data[item.key()]
+        return self.values[self._field_storage.index(item)]
 
     def __setitem__(self, item: FieldProto, value):
-        if item.multifield:
-            if not isinstance(value, list):
-                raise TypeError()
-            for s in value:
-                if not isinstance(s, str):
-                    raise TypeError()
-        else:
-            if not isinstance(value, str):
-                raise TypeError()
-        self.data[item.key()] = value
+        item.check(value)
+        self.values[self._field_storage.index(item)] = value
 
     def __delitem__(self, item: FieldProto):
-        self[item] = [] if item.multifield else ''
+        self[item] = item.default()
 
     def __init__(self, snapshots, fs):
-        if not self._field_storage.is_finalized:
+        storage = self._field_storage
+        if not storage.is_finalized:
             raise ValueError("Class is not finalized")
 
         self.snapshots = snapshots
-        self.data = {}
-
-        self[FieldProto('PATH')] = fs['path']
-
-        for proto in self._field_storage.by_key.values():
-            if proto.frame == 'PATH':
-                continue
-            del self[proto]
+        self.values = storage.new_values()
+        self.values[storage.path_index] = fs['path']
 
+        decoders = storage.decoders
         for tag in fs['tags']:
+            # frames without registered fields are skipped without parsing
+            fields = decoders.get(tag[:tag.find('(')])
+            if fields is None:
+                continue
             name, kwargs = self.snapshots.parse_frame_snapshot(tag)
 
-            desc = kwargs.get('desc', None)
-            if name != 'TXXX':
-                desc = None
-            if desc is not None:
-                desc = desc.upper()
+            desc = None
+            if name == 'TXXX':
+                desc = kwargs.get('desc', None)
+                if desc is not None:
+                    desc = desc.upper()
 
-            key = (name, desc)
-
-            if key not in self._field_storage.by_key:
+            proto = fields.get(desc)
+            if proto is None:
                 continue
-            proto = self._field_storage.by_key[key]
-
-            if name == 'APIC':
-                value = kwargs['path']
-            elif name == 'USLT':
-                value = kwargs['text']
-            else:
-                value = kwargs['text']
-                if not proto.multifield:
-                    value = value[0]
-
-            self[proto] = value
+            value = proto.decode(kwargs)
+            proto.check(value)
+            self.values[proto.index] = value
 
     def write(self, fs):
-        path = self[FieldProto('PATH')]
+        storage = self._field_storage
+        path = self.values[storage.path_index]
 
         tags = []
-        for proto in self._field_storage.by_key.values():
-            value = self[proto]
-
+        for proto, value in zip(storage.layout, self.values):
             if not value:
                 continue
 
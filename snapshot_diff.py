@@ -0,0 +1,114 @@
+from collections import defaultdict
+
+
+class SnapshotMismatchError(Exception):
+    def __init__(self, missing, extra):
+        self.missing = missing
+        self.extra = extra
+
+    def __str__(self):
+        return (
+            f'Snapshots contain different audio: {len(self.missing)} hashes are missing from the collection, '
+            f'{len(self.extra)} hashes are missing from the target (e.g. {(self.missing + self.extra)[:5]})'
+        )
+
+
+class SubtreeMismatchError(SnapshotMismatchError):
+    def __init__(self, subpath, paths):
+        super().__init__([], [])
+        self.subpath = subpath
+        self.paths = paths
+
+    def __str__(self):
+        return (
+            f'Target changes {len(self.paths)} records outside {self.subpath!r} '
+            f'(e.g. {self.paths[:5]})'
+        )
+
+
+class Changeset:
+    def __init__(self):
+        self.unchanged = []
+        self.moved = []
+        self.retagged = []
+        self.moved_and_retagged = []
+        self.duplicates = {}
+
+    def changed(self):
+        return self.moved + self.retagged + self.moved_and_retagged
+
+    def add(self, cur_fs, new_fs, cur_key, new_key):
+        pair = (cur_fs, new_fs)
+        same_path = cur_key[0] == new_key[0]
+        same_tags = cur_key[1] == new_key[1]
+        if same_path and same_tags:
+            self.unchanged.append(pair)
+        elif same_tags:
+            self.moved.append(pair)
+        elif same_path:
+            self.retagged.append(pair)
+        else:
+            self.moved_and_retagged.append(pair)
+
+
+def record_key(fs):
+    return fs['path'], tuple(sorted(fs['tags']))
+
+
+def index_by_hash(cs):
+    result = defaultdict(list)
+    for fs in cs:
+        result[fs['hash']].append((record_key(fs), fs))
+    return result
+
+
+def take_matching(cur_group, new_group, same):
+    pairs = []
+    rest = []
+    for new_item in new_group:
+        for i, cur_item in enumerate(cur_group):
+            if same(cur_item[0], new_item[0]):
+                pairs.append((cur_group.pop(i), new_item))
+                break
+        else:
+            rest.append(new_item)
+    return pairs, rest
+
+
+def match_group(cur_group, new_group):
+    # prefer pairing identical records, then the same file, then the same tags
+    cur_group = sorted(cur_group, key=lambda item: item[0][0])
+    new_group = sorted(new_group, key=lambda item: item[0][0])
+    pairs = []
+    for same in [
+        lambda lhs, rhs: lhs == rhs,
+        lambda lhs, rhs: lhs[0] == rhs[0],
+        lambda lhs, rhs: lhs[1] == rhs[1],
+    ]:
+        matched, new_group = take_matching(cur_group, new_group, same)
+        pairs.extend(matched)
+    pairs.extend(zip(cur_group, new_group))
+    return pairs
+
+
+def diff_snapshots(cur_cs, new_cs):
+    cur_by_hash = index_by_hash(cur_cs)
+    new_by_hash = index_by_hash(new_cs)
+
+    missing = sorted(h for h in new_by_hash if len(new_by_hash[h]) != len(cur_by_hash.get(h, ())))
+    extra = sorted(h for h in cur_by_hash if h not in new_by_hash)
+    if missing or extra:
+        raise SnapshotMismatchError(missing, extra)
+
+    changeset = Changeset()
+    for h, new_group in new_by_hash.items():
+        cur_group = cur_by_hash[h]
+        if len(cur_group) > 1:
+            changeset.duplicates[h] = len(cur_group)
+        if len(cur_group) == 1:
+            pairs = [(cur_group[0], new_group[0])]
+        else:
+            pairs = match_group(cur_group, new_group)
+        for (cur_key, cur_fs), (new_key, new_fs) in pairs:
+            changeset.add(cur_fs, new_fs, cur_key, new_key)
+    return changeset
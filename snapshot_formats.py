@@ -0,0 +1,176 @@
+import json
+import struct
+import posixpath
+
+
+class JsonWriter:
+    def __init__(self, f, sort):
+        self.f = f
+        self.sort = sort
+        self.snapshot = []
+
+    def write(self, fs):
+        self.snapshot.append(fs)
+
+    def close(self):
+        snapshot = self.snapshot
+        if self.sort:
+            snapshot = sorted(snapshot, key=lambda fs: fs['path'])
+        json.dump(snapshot, self.f, indent=4, ensure_ascii=False)
+
+
+class JsonFormat:
+    extension = '.json'
+    binary = False
+    streaming = False
+
+    def writer(self, f, sort=True):
+        return JsonWriter(f, sort)
+
+    def iter_load(self, f):
+        yield from json.load(f)
+
+
+class SortingWriter:
+    # streaming formats write records as they come, so a sorted snapshot has to be buffered until close
+    def __init__(self, writer):
+        self.writer = writer
+        self.snapshot = []
+
+    def write(self, fs):
+        self.snapshot.append(fs)
+
+    def close(self):
+        for fs in sorted(self.snapshot, key=lambda fs: fs['path']):
+            self.writer.write(fs)
+        self.writer.close()
+
+
+class JsonLinesWriter:
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, fs):
+        self.f.write(json.dumps(fs, ensure_ascii=False))
+        self.f.write('\n')
+
+    def close(self):
+        pass
+
+
+class JsonLinesFormat:
+    # one record per line: read lazily and, with sort=False, written while scanning in the order of the scan
+    extension = '.jsonl'
+    binary = False
+    streaming = True
+
+    def writer(self, f, sort=True):
+        writer = JsonLinesWriter(f)
+        return SortingWriter(writer) if sort else writer
+
+    def iter_load(self, f):
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+binary_magic = b'MTSNAP\x00\x01'
+binary_footer_magic = b'MTSNAPEN'
+binary_footer = struct.Struct('<QQ8s')
+binary_length = struct.Struct('<I')
+binary_record = struct.Struct('<IqBI')
+
+
+class BinaryWriter:
+    def __init__(self, f):
+        self.f = f
+        self.strings = {}
+        self.count = 0
+        f.write(binary_magic)
+
+    def string_index(self, s):
+        index = self.strings.get(s)
+        if index is None:
+            index = self.strings[s] = len(self.strings)
+        return index
+
+    def write(self, fs):
+        path = fs['path'].encode('utf8')
+        h = fs['hash'].encode('ascii')
+        tags = [self.string_index(tag) for tag in fs['tags']]
+        self.f.write(b''.join([
+            binary_record.pack(len(path), fs['modified'], len(h), len(tags)),
+            path,
+            h,
+            struct.pack(f'<{len(tags)}I', *tags),
+        ]))
+        self.count += 1
+
+    def close(self):
+        table_offset = self.f.tell()
+        self.f.write(binary_length.pack(len(self.strings)))
+        for s in self.strings:
+            data = s.encode('utf8')
+            self.f.write(binary_length.pack(len(data)))
+            self.f.write(data)
+        self.f.write(binary_footer.pack(table_offset, self.count, binary_footer_magic))
+
+
+class BinaryFormat:
+    # frame snapshots repeat across whole albums, so each distinct one is stored once in a string table
+    # at the end of the file and records refer to it by index
+    extension = '.msnap'
+    binary = True
+    streaming = True
+
+    def writer(self, f, sort=True):
+        writer = BinaryWriter(f)
+        return SortingWriter(writer) if sort else writer
+
+    def iter_load(self, f):
+        data = f.read()
+        if not data.startswith(binary_magic):
+            raise ValueError('Not a binary snapshot')
+        table_offset, count, footer_magic = binary_footer.unpack_from(data, len(data) - binary_footer.size)
+        if footer_magic != binary_footer_magic:
+            raise ValueError('Binary snapshot is truncated')
+
+        pos = table_offset
+        table_size, = binary_length.unpack_from(data, pos)
+        pos += binary_length.size
+        table = []
+        for _ in range(table_size):
+            length, = binary_length.unpack_from(data, pos)
+            pos += binary_length.size
+            table.append(data[pos:pos + length].decode('utf8'))
+            pos += length
+
+        unpack_record = binary_record.unpack_from
+        record_size = binary_record.size
+        pos = len(binary_magic)
+        for _ in range(count):
+            path_length, modified, hash_length, tag_count = unpack_record(data, pos)
+            pos += record_size
+            path = data[pos:pos + path_length].decode('utf8')
+            pos += path_length
+            h = data[pos:pos + hash_length].decode('ascii')
+            pos += hash_length
+            tags = struct.unpack_from(f'<{tag_count}I', data, pos)
+            pos += 4 * tag_count
+            yield {
+                'path': path,
+                'modified': modified,
+                'hash': h,
+                'tags': [table[i] for i in tags],
+            }
+
+
+formats = [JsonFormat(), JsonLinesFormat(), BinaryFormat()]
+
+
+def get_format(name):
+    extension = posixpath.splitext(name)[1]
+    for snapshot_format in formats:
+        if snapshot_format.extension == extension:
+            return snapshot_format
+    return formats[0]
@@ -0,0 +1,221 @@
+import re
+from ast import literal_eval
+from functools import lru_cache
+
+from mutagen.id3 import PictureType, Encoding, ID3TimeStamp
+
+
+token_pattern = re.compile(r'''\s*(?:
+    (?P<string>[bB]?(?:'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"))
+    |(?P<number>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)
+    |(?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?)
+    |(?P<punct>[()\[\]{},:=])
+)''', re.VERBOSE | re.DOTALL)
+
+constants = {
+    'True': True,
+    'False': False,
+    'None': None,
+}
+
+enums = {
+    'Encoding': Encoding,
+    'PictureType': PictureType,
+}
+
+constructors = {
+    'Encoding': Encoding,
+    'PictureType': PictureType,
+    'ID3TimeStamp': ID3TimeStamp,
+}
+
+
+class SnapshotSyntaxError(ValueError):
+    def __init__(self, text, pos, expected):
+        self.text = text
+        self.pos = pos
+        self.expected = expected
+
+    def __str__(self):
+        return f'Expected {self.expected} at position {self.pos} in snapshot {self.text!r}'
+
+
+class Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        self.positions = []
+        pos = 0
+        end = len(text.rstrip())
+        while pos < end:
+            match = token_pattern.match(text, pos)
+            if match is None:
+                raise SnapshotSyntaxError(text, pos, 'token')
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            self.positions.append(match.start(match.lastgroup))
+            pos = match.end()
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def error(self, expected):
+        pos = self.positions[self.pos] if self.pos < len(self.positions) else len(self.text)
+        return SnapshotSyntaxError(self.text, pos, expected)
+
+    def take(self, kind, value=None):
+        token_kind, token_value = self.peek()
+        if token_kind != kind or (value is not None and token_value != value):
+            raise self.error(value or kind)
+        self.pos += 1
+        return token_value
+
+    def skip(self, value):
+        if self.peek() == ('punct', value):
+            self.pos += 1
+            return True
+        return False
+
+    def finish(self):
+        if self.pos != len(self.tokens):
+            raise self.error('end of snapshot')
+
+    def string(self, token):
+        if '\\' not in token and token[0] in '\'"':
+            return token[1:-1]
+        return literal_eval(token)
+
+    def value(self):
+        kind, token = self.peek()
+        if kind == 'string':
+            self.pos += 1
+            return self.string(token)
+        if kind == 'number':
+            self.pos += 1
+            return literal_eval(token)
+        if kind == 'name':
+            self.pos += 1
+            if token in constants:
+                return constants[token]
+            if '.' in token:
+                enum, member = token.split('.')
+                if enum in enums:
+                    value = getattr(enums[enum], member, None)
+                    if isinstance(value, enums[enum]):
+                        return value
+                raise self.error('known constant')
+            if token in constructors:
+                self.take('punct', '(')
+                value = self.value()
+                self.take('punct', ')')
+                return constructors[token](value)
+            raise self.error('known constant')
+        if self.skip('['):
+            return self.items(']')
+        if self.skip('{'):
+            return self.dict_items()
+        if self.skip('('):
+            # a single value in parentheses is a tuple only when followed by a comma
+            if self.skip(')'):
+                return ()
+            value = self.value()
+            if not self.skip(','):
+                self.take('punct', ')')
+                return value
+            return tuple([value] + self.items(')'))
+        raise self.error('value')
+
+    def items(self, end):
+        result = []
+        while not self.skip(end):
+            result.append(self.value())
+            if not self.skip(','):
+                self.take('punct', end)
+                break
+        return result
+
+    def dict_items(self):
+        result = {}
+        while not self.skip('}'):
+            key = self.value()
+            self.take('punct', ':')
+            result[key] = self.value()
+            if not self.skip(','):
+                self.take('punct', '}')
+                break
+        return result
+
+    def frame(self):
+        name = self.take('name')
+        kwargs = {}
+        self.take('punct', '(')
+        while not self.skip(')'):
+            key = self.take('name')
+            self.take('punct', '=')
+            kwargs[key] = self.value()
+            if not self.skip(','):
+                self.take('punct', ')')
+                break
+        return name, kwargs
+
+
+class FrozenList(tuple):
+    pass
+
+
+class FrozenDict(tuple):
+    pass
+
+
+def freeze(value):
+    if isinstance(value, list):
+        return FrozenList(map(freeze, value))
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, tuple):
+        return tuple(map(freeze, value))
+    return value
+
+
+def thaw(value):
+    if isinstance(value, FrozenList):
+        return list(map(thaw, value))
+    if isinstance(value, FrozenDict):
+        return dict((key, thaw(item)) for key, item in value)
+    if isinstance(value, tuple):
+        return tuple(map(thaw, value))
+    return value
+
+
+@lru_cache(maxsize=1 << 16)
+def _parse_frame_snapshot(frame_snapshot):
+    parser = Parser(frame_snapshot)
+    name, kwargs = parser.frame()
+    parser.finish()
+    return name, tuple((key, freeze(value)) for key, value in kwargs.items())
+
+
+@lru_cache(maxsize=1 << 12)
+def _parse_attr_snapshot(attr_snapshot):
+    parser = Parser(attr_snapshot)
+    value = parser.value()
+    parser.finish()
+    return freeze(value)
+
+
+def parse_frame_snapshot(frame_snapshot):
+    name, kwargs = _parse_frame_snapshot(frame_snapshot)
+    return name, dict((key, thaw(value)) for key, value in kwargs)
+
+
+def parse_attr_snapshot(attr_snapshot):
+    return thaw(_parse_attr_snapshot(attr_snapshot))
+
+
+def cache_info():
+    return {
+        'frames': _parse_frame_snapshot.cache_info(),
+        'attrs': _parse_attr_snapshot.cache_info(),
+    }
@@ -1,13 +1,20 @@
 import os
-import json
 import hashlib
 import mimetypes
 import posixpath
+import uuid
+from collections import Counter
 from functools import wraps
+from contextlib import contextmanager
 
 from mutagen.id3 import ID3, PictureType, Encoding, ID3TimeStamp
 import mutagen.id3
 
+import snapshot_parser
+from snapshot_formats import get_format
+from picture_store import PictureStore
+from metrics import metrics
+
 
 def replace_default(frame_type, name, default):
     for spec in frame_type._framespec:
@@ -31,25 +38,88 @@ def get_mime_by_path(path):
     return mimetypes.guess_type(path)[0]
 
 
-def get_kwargs(**kwargs):
-    return kwargs
+def get_frame_type(name):
+    frame_type = getattr(mutagen.id3, name, None)
+    if not (isinstance(frame_type, type) and issubclass(frame_type, mutagen.id3.Frame)):
+        raise ValueError(f'Unknown frame type: {name}')
+    return frame_type
+
+
+verify_full = 'full'
+verify_sampled = 'sampled'
+verify_off = 'off'
+verify_levels = [verify_full, verify_sampled, verify_off]
+
+
+class VerificationStats:
+    def __init__(self):
+        self.checked = Counter()
+        self.skipped = Counter()
+        self.failed = Counter()
+
+    def as_dict(self):
+        return {
+            'checked': dict(self.checked),
+            'skipped': dict(self.skipped),
+            'failed': dict(self.failed),
+        }
+
+    def take(self):
+        # counts of a worker process since the last call, to be merged by the parent
+        data = self.as_dict()
+        self.__init__()
+        return data
+
+    def merge(self, data):
+        self.checked.update(data['checked'])
+        self.skipped.update(data['skipped'])
+        self.failed.update(data['failed'])
 
 
 def serialize_check(serialize):
+    kind = serialize.__name__[len('serialize_'):]
+
     @wraps(serialize)
     def with_check(self, obj):
         result = serialize(self, obj)
+        if not self.need_verify(kind, obj):
+            self.verification_stats.skipped[kind] += 1
+            return result
         deserialize = getattr(self, 'de' + serialize.__name__)
-        assert self.equal(deserialize(result), obj)
+        self.verification_stats.checked[kind] += 1
+        with metrics.phase('verify'):
+            equal = self.equal(deserialize(result), obj)
+        if not equal:
+            self.verification_stats.failed[kind] += 1
+            raise AssertionError(f'Serialized {kind} does not match the original: {result!r}')
         return result
     return with_check
 
 
 class Snapshots:
-    def __init__(self, snapshot_root):
+    def __init__(self, snapshot_root, verify=verify_full, verify_sample=100):
+        if verify not in verify_levels:
+            raise ValueError(f'Unknown verification level: {verify}')
         self.snapshot_root = snapshot_root
         self.picture_dir = posixpath.join(snapshot_root, 'pictures/')
-        os.makedirs(self.picture_dir, exist_ok=True)
+        self.verify = verify
+        self.verify_sample = verify_sample
+        self.verified_types = set()
+        self.verify_counter = Counter()
+        self.verification_stats = VerificationStats()
+        self.pictures = PictureStore(self.picture_dir)
+
+    def need_verify(self, kind, obj):
+        if self.verify == verify_full:
+            return True
+        if self.verify == verify_off:
+            return False
+        obj_type = (kind, type(obj).__name__)
+        if obj_type not in self.verified_types:
+            self.verified_types.add(obj_type)
+            return True
+        self.verify_counter[kind] += 1
+        return self.verify_counter[kind] % self.verify_sample == 0
 
     def equal(self, lhs, rhs):
         if isinstance(lhs, ID3) and isinstance(rhs, ID3):
@@ -57,19 +127,15 @@ class Snapshots:
         return repr(lhs) == repr(rhs)
 
     def serialize_picture(self, data, mime):
-        name = hashlib.md5(data).hexdigest()
-        name += get_extension_by_mime(mime)
-        path = posixpath.join(self.picture_dir, name)
-        if not posixpath.exists(path):
-            with open(path, 'wb') as f:
-                f.write(data)
+        extension = get_extension_by_mime(mime)
+        name = self.pictures.find(data, extension)
+        if name is None:
+            name = hashlib.md5(data).hexdigest() + extension
+            self.pictures.put(name, data)
         return name
 
     def deserialize_picture(self, path):
-        path = posixpath.join(self.picture_dir, path)
-        with open(path, 'rb') as f:
-            data = f.read()
-        return data
+        return self.pictures.get(path)
 
     @serialize_check
     def serialize_attr(self, attr):
@@ -82,11 +148,11 @@ class Snapshots:
         return result
 
     def deserialize_attr(self, attr_snapshot):
-        return eval(attr_snapshot)
+        return snapshot_parser.parse_attr_snapshot(attr_snapshot)
 
     def _make_frame_snapshot(self, name, has_attr, get_attr, get_pic):
         kw = []
-        cls = eval('mutagen.id3.' + name)
+        cls = get_frame_type(name)
         for spec in [cls._framespec, cls._optionalspec]:
             for attr_type in spec:
                 attr_name = attr_type.name
@@ -128,13 +194,13 @@ class Snapshots:
         return mutagen.id3.APIC(*args, **kwargs)
 
     def deserialize_frame(self, frame_snapshot):
-        prefix = 'self.' if frame_snapshot.startswith('APIC') else 'mutagen.id3.'
-        return eval(prefix + frame_snapshot)
+        name, kwargs = self.parse_frame_snapshot(frame_snapshot)
+        if name == 'APIC':
+            return self.APIC(**kwargs)
+        return get_frame_type(name)(**kwargs)
 
     def parse_frame_snapshot(self, frame_snapshot):
-        name = frame_snapshot[:4]
-        kwargs = eval('get_kwargs' + frame_snapshot[4:])
-        return name, kwargs
+        return snapshot_parser.parse_frame_snapshot(frame_snapshot)
 
     def build_frame_snapshot(self, name, kwargs):
         def get_pic():
@@ -167,20 +233,48 @@ class Snapshots:
             result.add(self.deserialize_frame(frame_snapshot))
         return result
 
-    def save(self, snapshot, name, sort=True):
+    def open_snapshot(self, path, mode, snapshot_format):
+        if snapshot_format.binary:
+            return open(path, mode + 'b')
+        return open(path, mode, encoding='utf8', newline='\n')
+
+    @contextmanager
+    def open_writer(self, name, sort=True):
         path = posixpath.join(self.snapshot_root, name)
+        snapshot_format = get_format(name)
+        temp = path + '.' + uuid.uuid4().hex + '.tmp'
+        try:
+            with self.open_snapshot(temp, 'w', snapshot_format) as f:
+                writer = snapshot_format.writer(f, sort)
+                yield writer
+                writer.close()
+            os.replace(temp, path)
+        finally:
+            if posixpath.exists(temp):
+                os.remove(temp)
+
+    @metrics.timed('save')
+    def save(self, snapshot, name, sort=True):
         if sort:
             snapshot = sorted(snapshot, key=lambda fs: fs['path'])
-        with open(path, 'w', encoding='utf8', newline='\n') as f:
-            json.dump(snapshot, f, indent=4, ensure_ascii=False)
+        with self.open_writer(name, sort=False) as writer:
+            for fs in snapshot:
+                writer.write(fs)
 
-    def load(self, name):
+    def iter_load(self, name):
         path = posixpath.join(self.snapshot_root, name)
-        with open(path, 'r', encoding='utf8') as f:
-            snapshot = json.load(f)
-        return snapshot
-
-    def filter_pictures(self, rool):
-        for filename in os.listdir(self.picture_dir):
-            if not rool(filename):
-                os.remove(posixpath.join(self.picture_dir, filename))
+        snapshot_format = get_format(name)
+        with self.open_snapshot(path, 'r', snapshot_format) as f:
+            yield from snapshot_format.iter_load(f)
+
+    @metrics.timed('load')
+    def load(self, name):
+        return list(self.iter_load(name))
+
+    def convert(self, src_name, dst_name):
+        self.save(self.iter_load(src_name), dst_name, sort=False)
+
+    def remove_pictures(self, names):
+        for name in names:
+            self.pictures.remove(name)
+        self.pictures.remove_empty_shards()
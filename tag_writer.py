@@ -0,0 +1,124 @@
+import os
+import re
+import json
+import uuid
+import shutil
+import posixpath
+
+from mutagen.id3 import ID3, BitPaddedInt, MakeID3v1, error as ID3Error
+from mutagen.id3._id3v1 import find_id3v1
+
+from metrics import metrics
+
+
+copy_temp_pattern = re.compile(r'\.[0-9a-f]{32}\.tmp$')
+
+
+def default_padding(info):
+    return info.get_default_padding()
+
+
+def write_backup(backup_dir, real_path, f, regions):
+    os.makedirs(backup_dir, exist_ok=True)
+    header = json.dumps({'path': real_path, 'regions': regions}, ensure_ascii=False)
+    name = uuid.uuid4().hex
+    temp = posixpath.join(backup_dir, name + '.tmp')
+    backup = posixpath.join(backup_dir, name + '.bak')
+    with open(temp, 'wb') as b:
+        b.write(header.encode('utf8') + b'\n')
+        for offset, length in regions:
+            f.seek(offset)
+            b.write(f.read(length))
+        b.flush()
+        os.fsync(b.fileno())
+    os.replace(temp, backup)
+    return backup
+
+
+def restore_backup(backup):
+    with open(backup, 'rb') as b:
+        header = json.loads(b.readline().decode('utf8'))
+        with open(header['path'], 'r+b') as f:
+            for offset, length in header['regions']:
+                f.seek(offset)
+                f.write(b.read(length))
+            f.flush()
+            os.fsync(f.fileno())
+    os.remove(backup)
+
+
+def restore_backups(backup_dir):
+    if not posixpath.isdir(backup_dir):
+        return []
+    restored = []
+    for name in sorted(os.listdir(backup_dir)):
+        path = posixpath.join(backup_dir, name)
+        if name.endswith('.bak'):
+            restore_backup(path)
+            restored.append(path)
+        else:
+            os.remove(path)
+    return restored
+
+
+def save_in_place(tags: ID3, real_path, backup_dir):
+    # only possible when mutagen would keep the current tag size: then the
+    # result is byte-identical to a full save and the audio is not moved
+    with open(real_path, 'r+b') as f:
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b'ID3' or header[5] & 0x10:
+            return False
+        old_size = BitPaddedInt(header[6:10]) + 10
+        try:
+            data = tags._prepare_data(f, 0, old_size, 4, '/', default_padding)
+        except ID3Error:
+            return False
+        if len(data) != old_size:
+            return False
+
+        regions = [(0, old_size)]
+        v1_tag, v1_offset = find_id3v1(f)
+        f.seek(0, 2)
+        file_size = f.tell()
+        if v1_tag is not None:
+            if v1_offset != -128:
+                return False
+            regions.append((file_size + v1_offset, -v1_offset))
+
+        backup = write_backup(backup_dir, real_path, f, regions)
+        f.seek(0)
+        f.write(data)
+        if v1_tag is not None:
+            f.seek(v1_offset, 2)
+            f.write(MakeID3v1(tags))
+        f.flush()
+        os.fsync(f.fileno())
+    return backup
+
+
+def is_copy_temp(name):
+    return copy_temp_pattern.match(name) is not None
+
+
+def remove_copy_temps(real_dir):
+    if not posixpath.isdir(real_dir):
+        return []
+    removed = []
+    for name in sorted(os.listdir(real_dir)):
+        if is_copy_temp(name):
+            path = posixpath.join(real_dir, name)
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def save_by_copy(tags: ID3, real_path):
+    temp = posixpath.join(posixpath.dirname(real_path), '.' + uuid.uuid4().hex + '.tmp')
+    shutil.copy2(real_path, temp)
+    metrics.count('bytes_copied', os.path.getsize(temp))
+    try:
+        tags.save(temp)
+    except Exception as ex:
+        os.remove(temp)
+        raise ex
+    return temp
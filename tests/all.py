@@ -1,12 +1,28 @@
 import unittest
+import io
 import os
+import sys
 import posixpath
 import shutil
 import filecmp
 import json
 import mutagen.id3
-
-from collection import Snapshots, Collection
+from copy import deepcopy
+
+import autofix
+from collection import Snapshots, Collection, get_mp3_hash, get_mp3_hash_by_copy
+from snapshot_parser import parse_frame_snapshot, SnapshotSyntaxError
+from tag_writer import save_in_place, save_by_copy, restore_backups
+from apply_plan import build_move_chains
+from journal import ApplyJournal
+from snapshot_formats import get_format
+from snapshot_diff import diff_snapshots, SnapshotMismatchError, SubtreeMismatchError
+from fix_state import FixState
+from simple_tags import FieldProto
+from my_tags import MyTags, PATH, ARTIST, COUNTRY
+from metrics import metrics
+from progress import ConsoleProgress, ProgressEvent, file_started, file_hashed
+from watch import Watcher
 
 
 test_root = posixpath.dirname(posixpath.abspath(__file__))
@@ -14,6 +30,15 @@ test_data_root = posixpath.join(test_root, 'data')
 work_root = posixpath.join(test_root, 'work')
 
 
+def make_work_music(test_name):
+    work_dir = posixpath.join(work_root, test_name)
+    if posixpath.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    music_dir = posixpath.join(work_dir, 'music')
+    shutil.copytree(posixpath.join(test_data_root, 'multiple_files', 'music'), music_dir)
+    return work_dir, music_dir
+
+
 def create_collection(data_path, snapshot_root, music_root, name):
     with open(data_path, 'r') as f:
         cs = json.load(f)
@@ -97,7 +122,7 @@ class AllTests(unittest.TestCase):
         self.folders_equal(posixpath.join(result_dir, 'pictures'), posixpath.join(work_dir, 'result', 'pictures'))
         self.snapshots_equal(posixpath.join(result_dir, 'data.json'), posixpath.join(work_dir, 'result', 'data.json'))
 
-    def impl_test_apply(self, data_name, test_name):
+    def impl_test_apply(self, data_name, test_name, jobs=1, crash_after=None):
         work_dir = posixpath.join(work_root, test_name)
         if posixpath.isdir(work_dir):
             shutil.rmtree(work_dir)
@@ -117,7 +142,24 @@ class AllTests(unittest.TestCase):
         snapshots2 = Snapshots(result2_dir)
         Collection(snapshots1, music2_dir)
 
-        collection1.apply_snapshot(snapshots2.load('data.json'))
+        if crash_after is None:
+            collection1.apply_snapshot(snapshots2.load('data.json'), jobs=jobs)
+        else:
+            move_file = collection1.move_file
+            moves = []
+
+            def crashing_move_file(cur_path, new_path):
+                if len(moves) == crash_after:
+                    raise OSError('simulated crash')
+                moves.append(cur_path)
+                move_file(cur_path, new_path)
+
+            collection1.move_file = crashing_move_file
+            with self.assertRaises(OSError):
+                collection1.apply_snapshot(snapshots2.load('data.json'))
+            collection1 = Collection(snapshots1, music1_dir, need_update=False)
+            self.assertIsNotNone(collection1.resume_apply())
+            self.assertFalse(posixpath.exists(posixpath.join(result1_dir, 'apply_journal')))
         collection1.remove_unused_pictures()
         snapshots1.save(collection1.state, 'data.json')
 
@@ -125,6 +167,486 @@ class AllTests(unittest.TestCase):
         self.folders_equal(posixpath.join(result1_dir, 'pictures'), posixpath.join(result2_dir, 'pictures'))
         self.snapshots_equal(posixpath.join(result1_dir, 'data.json'), posixpath.join(result2_dir, 'data.json'))
 
+    def impl_test_hash(self, data_name):
+        music_dir = posixpath.join(test_data_root, data_name, 'music')
+        for dirpath, dirnames, filenames in os.walk(music_dir):
+            for filename in filenames:
+                path = posixpath.join(dirpath, filename)
+                self.assertEqual(get_mp3_hash(path), get_mp3_hash_by_copy(path))
+
+    def test_hash_one_big_file(self):
+        self.impl_test_hash('one_big_file')
+
+    def test_hash_multiple_files(self):
+        self.impl_test_hash('multiple_files')
+
+    def test_scan_parallel(self):
+        work_dir = posixpath.join(work_root, 'scan_parallel')
+        if posixpath.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        music_dir = posixpath.join(test_data_root, 'multiple_files', 'music')
+
+        serial = Collection(Snapshots(posixpath.join(work_dir, 'serial')), music_dir)
+        parallel = Collection(Snapshots(posixpath.join(work_dir, 'parallel')), music_dir, jobs=3)
+
+        self.assertEqual(serial.state, parallel.state)
+        self.folders_equal(
+            posixpath.join(work_dir, 'serial', 'pictures'),
+            posixpath.join(work_dir, 'parallel', 'pictures'),
+        )
+        self.assertEqual(
+            serial.snapshots.verification_stats.as_dict(),
+            parallel.snapshots.verification_stats.as_dict(),
+        )
+        self.assertGreater(parallel.snapshots.verification_stats.checked['frame'], 0)
+
+    def test_scan_same_second_edit(self):
+        work_dir, music_dir = make_work_music('scan_same_second_edit')
+
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        collection = Collection(snapshots, music_dir)
+        path = posixpath.join(music_dir, 'f1.mp3')
+        stat = os.stat(path)
+        tags = mutagen.id3.ID3(path)
+        tags.add(mutagen.id3.TIT2(text=['t2']))
+        tags.save()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        collection = Collection(snapshots, music_dir, expected_cs=collection.state)
+        self.assertIn("TIT2(text=['t2'])", collection.by_path['f1.mp3']['tags'])
+
+    def test_scan_unchanged_dirs(self):
+        work_dir, music_dir = make_work_music('scan_unchanged_dirs')
+        dir_path = posixpath.join(music_dir, 'a', 'd')
+        os.utime(dir_path, (1000000000, 1000000000))
+
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        Collection(snapshots, music_dir)
+
+        # a listing is only trusted while the directory mtime is unchanged
+        shutil.copy2(posixpath.join(dir_path, 'f3.mp3'), posixpath.join(dir_path, 'f4.mp3'))
+        os.utime(dir_path, (1000000000, 1000000000))
+        collection = Collection(snapshots, music_dir)
+        self.assertNotIn('a/d/f4.mp3', collection.by_path)
+
+        os.utime(dir_path, (1000000001, 1000000001))
+        collection = Collection(snapshots, music_dir)
+        self.assertIn('a/d/f4.mp3', collection.by_path)
+
+    def test_scan_verification_levels(self):
+        work_dir = posixpath.join(work_root, 'scan_verification_levels')
+        if posixpath.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        music_dir = posixpath.join(test_data_root, 'multiple_files', 'music')
+
+        states = {}
+        for verify in ['full', 'sampled', 'off']:
+            snapshots = Snapshots(posixpath.join(work_dir, verify), verify=verify, verify_sample=3)
+            states[verify] = Collection(snapshots, music_dir).state
+            stats = snapshots.verification_stats
+            self.assertEqual(sum(stats.failed.values()), 0)
+            if verify == 'off':
+                self.assertEqual(sum(stats.checked.values()), 0)
+            else:
+                self.assertGreater(stats.checked['frame'], 0)
+        self.assertEqual(states['full'], states['sampled'])
+        self.assertEqual(states['full'], states['off'])
+
+    def test_set_tags_in_place(self):
+        work_dir, music_dir = make_work_music('set_tags_in_place')
+        path = posixpath.join(music_dir, 'f1.mp3')
+        with open(path, 'rb') as f:
+            original = f.read()
+
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        collection = Collection(snapshots, music_dir)
+        tags = collection.by_path['f1.mp3']['tags'] + ["TALB(text=['Album'])"]
+        collection.set_tags('f1.mp3', tags)
+        self.assertEqual(os.path.getsize(path), len(original))
+        self.assertEqual(sorted(collection.by_path['f1.mp3']['tags']), sorted(tags))
+        self.assertEqual(os.listdir(collection.backup_dir), [])
+
+        # an interrupted in-place write is rolled back from its backup
+        with open(path, 'rb') as f:
+            before = f.read()
+        self.assertTrue(save_in_place(snapshots.deserialize_tags(["TIT2(text=['x'])"]), path, collection.backup_dir))
+        restore_backups(collection.backup_dir)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), before)
+
+        # the temp file of a copy write is left alone by updates and removed when its apply is resumed
+        set_tags = collection.set_tags
+        temps = []
+
+        def crashing_set_tags(path, tags):
+            temps.append(save_by_copy(snapshots.deserialize_tags(tags), collection.real_path(path)))
+            raise OSError('simulated crash')
+
+        target = deepcopy(collection.state)
+        retagged = [fs for fs in target if fs['path'] == 'f2.mp3'][0]
+        retagged['tags'] = sorted(retagged['tags'] + ["TALB(text=['Album'])"])
+        collection.set_tags = crashing_set_tags
+        with self.assertRaises(OSError):
+            collection.apply_snapshot(target)
+        collection.set_tags = set_tags
+        collection.update()
+        self.assertTrue(posixpath.exists(temps[0]))
+        self.assertEqual(collection.resume_apply().retagged, 1)
+        self.assertFalse(any(name.endswith('.tmp') for name in os.listdir(music_dir)))
+        self.assertEqual(collection.by_path['f2.mp3']['tags'], retagged['tags'])
+
+    def test_apply_move_only(self):
+        work_dir, music_dir = make_work_music('apply_move_only')
+        size = os.path.getsize(posixpath.join(music_dir, 'f1.mp3'))
+
+        collection = Collection(Snapshots(posixpath.join(work_dir, 'result')), music_dir)
+        new_cs = deepcopy(collection.state)
+        for fs in new_cs:
+            if fs['path'] == 'f1.mp3':
+                fs['path'] = 'x/f1.mp3'
+        report = collection.apply_snapshot(new_cs)
+
+        self.assertEqual((report.moved, report.retagged, report.moved_and_retagged), (1, 0, 0))
+        self.assertEqual(report.rewrite_bytes_avoided, size)
+        self.assertTrue(posixpath.isfile(posixpath.join(music_dir, 'x', 'f1.mp3')))
+
+    def test_diff_snapshots(self):
+        def record(path, h, *tags):
+            return {'path': path, 'modified': 0, 'hash': h, 'tags': list(tags)}
+
+        cur_cs = [record('a', 'h1', 'T1'), record('b', 'h1', 'T2'), record('c', 'h1', 'T3'), record('d', 'h2', 'T4')]
+        new_cs = [record('a', 'h1', 'T1'), record('e', 'h1', 'T2'), record('c', 'h1', 'T5'), record('f', 'h2', 'T6')]
+        changeset = diff_snapshots(cur_cs, new_cs)
+        self.assertEqual([(cur['path'], new['path']) for cur, new in changeset.unchanged], [('a', 'a')])
+        self.assertEqual([(cur['path'], new['path']) for cur, new in changeset.retagged], [('c', 'c')])
+        self.assertEqual([(cur['path'], new['path']) for cur, new in changeset.moved], [('b', 'e')])
+        self.assertEqual([(cur['path'], new['path']) for cur, new in changeset.moved_and_retagged], [('d', 'f')])
+        self.assertEqual(changeset.duplicates, {'h1': 3})
+
+        with self.assertRaises(SnapshotMismatchError):
+            diff_snapshots(cur_cs, new_cs[:-1])
+
+    def test_snapshot_formats(self):
+        work_dir = posixpath.join(work_root, 'snapshot_formats')
+        if posixpath.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        music_dir = posixpath.join(test_data_root, 'multiple_files', 'music')
+
+        snapshots = Snapshots(work_dir)
+        collection = Collection(snapshots, music_dir, need_update=False)
+        with snapshots.open_writer('scan.jsonl') as writer:
+            collection.update(writer)
+        snapshots.save(collection.state, 'data.json')
+        snapshots.convert('data.json', 'data.jsonl')
+        snapshots.convert('data.jsonl', 'data.msnap')
+
+        expected = sorted(json.loads(json.dumps(collection.state)), key=lambda fs: fs['path'])
+        self.assertEqual(snapshots.load('data.jsonl'), expected)
+        self.assertEqual(snapshots.load('data.msnap'), expected)
+        self.assertEqual(snapshots.load('scan.jsonl'), expected)
+        for name in ['unsorted.jsonl', 'unsorted.msnap']:
+            with snapshots.open_writer(name) as writer:
+                for fs in reversed(expected):
+                    writer.write(fs)
+            self.assertEqual(snapshots.load(name), expected)
+        with open(posixpath.join(work_dir, 'data.jsonl')) as f:
+            self.assertEqual(len(f.readlines()), len(expected))
+
+        # unsorted streaming writers get every record as soon as the scan reaches it
+        with snapshots.open_writer('stream.jsonl', sort=not get_format('stream.jsonl').streaming) as writer:
+            sizes = [writer.f.tell() for event in collection.iter_update(writer) if event.kind != file_started]
+        self.assertGreater(sizes[0], 0)
+        self.assertEqual(sizes, sorted(set(sizes)))
+        self.assertEqual(sorted(snapshots.iter_load('stream.jsonl'), key=lambda fs: fs['path']), expected)
+
+    def test_picture_store_migration(self):
+        work_dir = posixpath.join(work_root, 'picture_store_migration')
+        if posixpath.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        shutil.copytree(posixpath.join(test_data_root, 'multiple_files', 'result'), work_dir)
+
+        snapshots = Snapshots(work_dir)
+        name = 'ec6ef230f1828039ee794566b9c58adc.jpg'
+        self.assertTrue(posixpath.isfile(posixpath.join(work_dir, 'pictures', 'ec', name)))
+        self.assertFalse(posixpath.exists(posixpath.join(work_dir, 'pictures', name)))
+        self.assertIsNone(snapshots.pictures._names)
+        self.assertIn(name, snapshots.pictures)
+        self.assertEqual(snapshots.serialize_picture(snapshots.deserialize_picture(name), 'image/jpeg'), name)
+
+    def test_remove_unused_pictures(self):
+        work_dir, music_dir = make_work_music('remove_unused_pictures')
+
+        collection = Collection(Snapshots(posixpath.join(work_dir, 'result')), music_dir)
+        name = '1d665b9b1467944c128a5575119d1cfd.jpg'
+        for path in ['a/b/c/f2.mp3', 'f3.mp3']:
+            tags = [tag for tag in collection.by_path[path]['tags'] if not tag.startswith('APIC')]
+            collection.set_tags(path, tags)
+
+        self.assertEqual(collection.remove_unused_pictures(dry_run=True), [name])
+        self.assertIn(name, collection.snapshots.pictures)
+        self.assertEqual(collection.remove_unused_pictures(), [name])
+        self.assertNotIn(name, collection.snapshots.pictures)
+        self.assertFalse(posixpath.exists(posixpath.join(work_dir, 'result', 'pictures', '1d')))
+
+    def test_picture_cache(self):
+        work_dir, music_dir = make_work_music('picture_cache')
+
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        collection = Collection(snapshots, music_dir)
+        pictures = snapshots.pictures
+        pictures.clear_cache()
+        for path in ['f2.mp3', 'a/d/f3.mp3']:
+            tags = collection.by_path[path]['tags'] + ["TALB(text=['Album'])"]
+            collection.set_tags(path, tags)
+        info = pictures.cache_info()
+        self.assertEqual(info['misses'], 1)
+        self.assertGreater(info['hits'], 0)
+        self.assertGreater(info['hash_skips'], 0)
+
+        pictures.cache_bytes = 0
+        pictures.clear_cache()
+        snapshots.deserialize_picture('ec6ef230f1828039ee794566b9c58adc.jpg')
+        self.assertEqual(pictures.cache_info()['pictures'], 0)
+
+    def test_normalizers(self):
+        self.assertEqual(autofix.capitalize(['  the  ost of o\'bannon mix ii ', 'dj shadow']),
+                         ["The OST Of O'Bannon Mix II", 'DJ Shadow'])
+        self.assertEqual(autofix.rym_escape('Þór & Sons – Live'), 'dor_and_sons___live')
+        hits = autofix.normalizer_cache_info()['capitalize'].hits
+        autofix.capitalize('dj shadow')
+        self.assertEqual(autofix.normalizer_cache_info()['capitalize'].hits, hits + 1)
+
+    def test_fix_incremental(self):
+        work_dir, music_dir = make_work_music('fix_incremental')
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        cs = Collection(snapshots, music_dir).state
+
+        expected = deepcopy(cs)
+        autofix.fix_cs(snapshots, expected)
+
+        state = FixState(snapshots, autofix.rules_version)
+        first = deepcopy(cs)
+        autofix.fix_cs(snapshots, first, state)
+        state.save()
+        self.assertEqual(first, expected)
+        self.assertEqual((state.fixed, state.reused), (len(cs), 0))
+
+        state = FixState(snapshots, autofix.rules_version)
+        state.load()
+        second = deepcopy(cs)
+        autofix.fix_cs(snapshots, second, state)
+        self.assertEqual(second, expected)
+        self.assertEqual((state.fixed, state.reused), (0, len(cs)))
+
+        state = FixState(snapshots, autofix.rules_version + 1)
+        state.load()
+        autofix.fix_cs(snapshots, deepcopy(cs), state)
+        self.assertEqual(state.reused, 0)
+
+    def test_fix_parallel(self):
+        work_dir, music_dir = make_work_music('fix_parallel')
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        cs = sorted(Collection(snapshots, music_dir).state, key=lambda fs: fs['path'])
+
+        for jobs, name in [(1, 'serial.json'), (2, 'parallel.json')]:
+            fixed = deepcopy(cs)
+            autofix.fix_cs(snapshots, fixed, jobs=jobs)
+            snapshots.save(fixed, name, sort=False)
+        self.assertTrue(filecmp.cmp(
+            posixpath.join(work_dir, 'result', 'serial.json'),
+            posixpath.join(work_dir, 'result', 'parallel.json'),
+            shallow=False,
+        ))
+
+    def test_field_layout(self):
+        snapshots = Snapshots(posixpath.join(work_root, 'field_layout'))
+        fs = {
+            'path': 'a.mp3',
+            'tags': ["COMM(text=['x'])", "TPE1(text=['A', 'B'])", "TXXX(desc='country', text=['UK'])"],
+        }
+        tags = MyTags(snapshots, fs)
+        self.assertFalse(hasattr(tags, '__dict__'))
+        self.assertEqual(tags[FieldProto('PATH')], 'a.mp3')
+        self.assertEqual(tags[ARTIST], ['A', 'B'])
+        self.assertEqual(tags[COUNTRY], 'UK')
+        tags[PATH] = 'b.mp3'
+        del tags[ARTIST]
+        tags.write(fs)
+        self.assertEqual(fs, {'path': 'b.mp3', 'tags': ["TXXX(desc='COUNTRY', text=['UK'])"], 'modified': -1})
+        self.assertEqual(MyTags(snapshots, fs)[ARTIST], [])
+
+    def test_metrics(self):
+        work_dir, music_dir = make_work_music('metrics')
+
+        metrics.reset()
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        Collection(snapshots, music_dir, jobs=2)
+        Collection(snapshots, music_dir)
+        path = posixpath.join(work_dir, 'result', 'metrics', 'update.json')
+        metrics.save(path, verification=snapshots.verification_stats.as_dict())
+        with open(path, encoding='utf8') as f:
+            report = json.load(f)
+        self.assertEqual(report['counters']['files_hashed'], 5)
+        self.assertEqual(report['counters']['files_reused'], 5)
+        self.assertEqual(report['phases']['update']['calls'], 2)
+        self.assertEqual(report['phases']['hash']['calls'], 5)
+        self.assertIn('walk', report['phases'])
+        self.assertIn('verification', report)
+
+    def test_update_progress(self):
+        work_dir, music_dir = make_work_music('update_progress')
+
+        events = []
+        collection = Collection(Snapshots(posixpath.join(work_dir, 'result')), music_dir, progress=events.append)
+        self.assertEqual([event.kind for event in events], ['started', 'hashed'] * 5)
+        self.assertEqual([event.path for event in events[::2]], sorted(collection.by_path))
+        events = list(collection.iter_update())
+        self.assertEqual([event.kind for event in events], ['started', 'reused'] * 5)
+
+        clock = iter(range(10)).__next__
+        stream = io.StringIO()
+        console = ConsoleProgress(interval=3, stream=stream, clock=clock)
+        for index in range(10):
+            console(ProgressEvent(file_hashed, f'{index}.mp3', index, 10, 1 << 20))
+        lines = stream.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['1/10', '4/10', '7/10', '10/10'])
+        self.assertIn('(0 reused, 10 hashed)', lines[-1])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on Linux')
+    def test_watch(self):
+        work_dir, music_dir = make_work_music('watch')
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        collection = Collection(snapshots, music_dir)
+        watcher = Watcher(collection, name='data.json', debounce=0, flush_interval=0)
+
+        tags = mutagen.id3.ID3(posixpath.join(music_dir, 'f1.mp3'))
+        tags.add(mutagen.id3.TALB(text=['Album']))
+        tags.save()
+        os.rename(posixpath.join(music_dir, 'a', 'd'), posixpath.join(music_dir, 'e'))
+        os.remove(posixpath.join(music_dir, 'f3.mp3'))
+        for _ in range(3):
+            watcher.poll(timeout=0.1)
+        watcher.inotify.close()
+
+        expected = Collection(Snapshots(posixpath.join(work_dir, 'expected')), music_dir).state
+        key = lambda fs: fs['path']
+        self.assertEqual(sorted(snapshots.load('data.json'), key=key), sorted(map(dict, expected), key=key))
+        self.assertIn("TALB(text=['Album'])", collection.by_path['f1.mp3']['tags'])
+        self.assertIn('e/f3.mp3', collection.by_path)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on Linux')
+    def test_watch_partial_files(self):
+        work_dir, music_dir = make_work_music('watch_partial_files')
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        collection = Collection(snapshots, music_dir)
+        watcher = Watcher(collection, name='data.json', debounce=0, max_delay=0, flush_interval=0)
+
+        with open(posixpath.join(music_dir, 'f1.mp3'), 'rb') as f:
+            data = f.read()
+        with open(posixpath.join(music_dir, 'new.mp3'), 'wb') as f:
+            f.write(data[:200])
+        watcher.poll(timeout=0.1)
+        self.assertNotIn('new.mp3', collection.by_path)
+        self.assertIn('new.mp3', watcher.retries)
+
+        # another process removed the cover, so the watcher must store it again
+        name = 'ec6ef230f1828039ee794566b9c58adc.jpg'
+        os.remove(snapshots.pictures.path(name))
+        with open(posixpath.join(music_dir, 'new.mp3'), 'wb') as f:
+            f.write(data)
+        for _ in range(3):
+            watcher.poll(timeout=0.1)
+        watcher.inotify.close()
+        self.assertEqual(collection.by_path['new.mp3']['tags'], collection.by_path['f1.mp3']['tags'])
+        self.assertEqual(watcher.retries, {})
+        self.assertTrue(posixpath.isfile(snapshots.pictures.path(name)))
+
+    def test_subtree(self):
+        work_dir, music_dir = make_work_music('subtree')
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        collection = Collection(snapshots, music_dir)
+        os.makedirs(posixpath.join(music_dir, '__Unsorted', 'album'))
+        shutil.copy(posixpath.join(music_dir, 'f3.mp3'), posixpath.join(music_dir, '__Unsorted', 'album', 'x.mp3'))
+
+        events = []
+        collection.update(progress=events.append, subpath='__Unsorted')
+        self.assertEqual([event.path for event in events], ['__Unsorted/album/x.mp3'] * 2)
+        self.assertEqual(len(collection.state), 6)
+
+        fs = deepcopy(collection.by_path['__Unsorted/album/x.mp3'])
+        fs['path'] = 'g/x.mp3'
+        fs['tags'] = sorted(fs['tags'] + ["TALB(text=['Album'])"])
+        target = [deepcopy(other) for other in collection.state if other['path'] != '__Unsorted/album/x.mp3'] + [fs]
+        with self.assertRaises(SnapshotMismatchError):
+            collection.apply_snapshot(target, subpath='a')
+        retagged = deepcopy(target)
+        retagged[0]['tags'] = retagged[0]['tags'] + ["TALB(text=['Other'])"]
+        with self.assertRaises(SubtreeMismatchError) as cm:
+            collection.apply_snapshot(retagged, subpath='__Unsorted')
+        self.assertEqual(cm.exception.paths, [retagged[0]['path']])
+        set_tags = collection.set_tags
+
+        def crashing_set_tags(path, tags):
+            raise OSError('simulated crash')
+
+        collection.set_tags = crashing_set_tags
+        with self.assertRaises(OSError):
+            collection.apply_snapshot(target, subpath='__Unsorted')
+        journal = ApplyJournal(snapshots, music_dir)
+        self.assertEqual(journal.changes(), [fs])
+        collection.set_tags = set_tags
+        report = collection.resume_apply()
+        self.assertEqual(report.retagged, 1)
+        self.assertFalse(posixpath.exists(posixpath.join(music_dir, '__Unsorted')))
+
+        expected = Collection(Snapshots(posixpath.join(work_dir, 'expected')), music_dir).state
+        key = lambda fs: fs['path']
+        self.assertEqual(sorted(map(dict, collection.state), key=key), sorted(map(dict, expected), key=key))
+
+        real_path = posixpath.join(music_dir, 'g', 'x.mp3')
+        os.remove(real_path)
+        collection.update(subpath='g/x.mp3')
+        self.assertNotIn('g/x.mp3', collection.by_path)
+        rows = collection.scan_index.connection.execute(
+            'SELECT path FROM files WHERE path = ?', (os.path.abspath(real_path),)
+        ).fetchall()
+        self.assertEqual(rows, [])
+
+    def test_parse_frame_snapshot(self):
+        frame_snapshot = "TXXX(encoding=Encoding.UTF16, desc='A', text=[\"it's\", 'x\\'y\\n'])"
+        name, kwargs = parse_frame_snapshot(frame_snapshot)
+        self.assertEqual(name, 'TXXX')
+        self.assertEqual(kwargs, {'encoding': mutagen.id3.Encoding.UTF16, 'desc': 'A', 'text': ["it's", "x'y\n"]})
+        kwargs['text'].append('z')
+        self.assertEqual(parse_frame_snapshot(frame_snapshot)[1]['text'], ["it's", "x'y\n"])
+        with self.assertRaises(SnapshotSyntaxError):
+            parse_frame_snapshot("TIT2(text=__import__('os').getcwd())")
+
+    def test_parse_tuples(self):
+        snapshots = Snapshots(posixpath.join(work_root, 'parse_tuples'))
+        frame = mutagen.id3.SYLT(encoding=3, lang='eng', format=2, type=1, desc='d', text=[('a', 10), ('b', 20)])
+        frame_snapshot = snapshots.serialize_frame(frame)
+        self.assertIn("text=[('a', 10), ('b', 20)]", frame_snapshot)
+        self.assertEqual(snapshots.deserialize_frame(frame_snapshot), frame)
+        frame = parse_frame_snapshot("TXXX(text=[(), (1,), (1), ((2, 3),)])")
+        self.assertEqual(frame[1]['text'], [(), (1,), 1, ((2, 3),)])
+
+    def test_parse_chapters(self):
+        work_dir, music_dir = make_work_music('parse_chapters')
+        snapshots = Snapshots(posixpath.join(work_dir, 'result'))
+        frame = mutagen.id3.CHAP(element_id='c1', start_time=0, end_time=1000, sub_frames=[])
+        frame_snapshot = snapshots.serialize_frame(frame)
+        self.assertIn('sub_frames={}', frame_snapshot)
+        self.assertEqual(snapshots.deserialize_frame(frame_snapshot), frame)
+        self.assertEqual(parse_frame_snapshot("TXXX(text=[{}, {'a': [1]}])")[1]['text'], [{}, {'a': [1]}])
+
+        tags = mutagen.id3.ID3(posixpath.join(music_dir, 'f1.mp3'))
+        tags.add(frame)
+        tags.save()
+        collection = Collection(snapshots, music_dir)
+        self.assertIn(frame_snapshot, collection.by_path['f1.mp3']['tags'])
+
     def test_create_one_big_file(self):
         self.impl_test_create('one_big_file', 'create_one_big_file')
 
@@ -152,6 +674,24 @@ class AllTests(unittest.TestCase):
     def test_apply_cycle(self):
         self.impl_test_apply('apply_cycle', 'apply_cycle')
 
+    def test_apply_chain_parallel(self):
+        self.impl_test_apply('apply_chain', 'apply_chain_parallel', jobs=4)
+
+    def test_apply_cycle_parallel(self):
+        self.impl_test_apply('apply_cycle', 'apply_cycle_parallel', jobs=4)
+
+    def test_apply_cycle_resume(self):
+        self.impl_test_apply('apply_cycle', 'apply_cycle_resume', crash_after=2)
+
+    def test_build_move_chains(self):
+        sources = ['a', 'b', 'c', 'd', 'e', 'f']
+        targets = ['b', 'c', 'x', 'e', 'd', 'f']
+        chains = build_move_chains(sources, targets, make_temp=lambda: 't')
+        self.assertEqual(chains, [
+            [('c', 'x'), ('b', 'c'), ('a', 'b')],
+            [('d', 't'), ('e', 'd'), ('t', 'e')],
+        ])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,46 @@
-from config import snapshot_root, music_root
+import argparse
+
+from config import snapshot_root, music_root, snapshot_name
 from collection import Snapshots, Collection
+from snapshots import verify_levels, verify_full
+from snapshot_formats import get_format
+from metrics import metrics, report_path
+from progress import ConsoleProgress
+import snapshot_parser
 
 
 if __name__ == '__main__':
-    snapshots = Snapshots(snapshot_root)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='number of scanning processes')
+    parser.add_argument('--gc-dry-run', action='store_true', help='only list pictures that are no longer used')
+    parser.add_argument('--verify', choices=verify_levels, default=verify_full, help='serialization check level')
+    parser.add_argument('--subpath', default='', help='only scan this file or folder relative to the music root')
+    parser.add_argument('--metrics', help='where to write the metrics report of the run')
+    args = parser.parse_args()
+
+    snapshots = Snapshots(snapshot_root, verify=args.verify)
     try:
-        cs = snapshots.load('data.json')
+        cs = snapshots.load(snapshot_name)
     except FileNotFoundError:
         cs = None
-    collection = Collection(snapshots, music_root, expected_cs=cs)
-    cs = collection.state
-    snapshots.save(cs, 'data.json')
-    collection.remove_unused_pictures()
+    collection = Collection(
+        snapshots, music_root, expected_cs=cs, need_update=False, jobs=args.jobs, progress=ConsoleProgress()
+    )
+    # streaming formats are written while scanning, in walk order; sorting would hold every record until the end
+    with snapshots.open_writer(snapshot_name, sort=not get_format(snapshot_name).streaming) as writer:
+        if collection.resume_apply() is None:
+            collection.update(writer, subpath=args.subpath)
+        else:
+            for fs in collection.state:
+                writer.write(fs)
+    unused = collection.remove_unused_pictures(dry_run=args.gc_dry_run)
+    if args.gc_dry_run:
+        for name in unused:
+            print('Unused picture:', name)
+
+    metrics.save(
+        args.metrics or report_path(snapshot_root, 'update'),
+        verification=snapshots.verification_stats.as_dict(),
+        snapshot_parser=snapshot_parser.cache_info(),
+        pictures=snapshots.pictures.cache_info(),
+    )
@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import argparse
+import posixpath
+
+from config import snapshot_root, music_root, snapshot_name
+from collection import Snapshots, Collection
+from snapshots import verify_levels, verify_full
+from progress import ConsoleProgress
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+event_header = struct.Struct('iIII')
+
+
+class Inotify:
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def check(self, result, path=None):
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return result
+
+    def add_watch(self, real_path, mask=watch_mask):
+        return self.check(self.libc.inotify_add_watch(self.fd, os.fsencode(real_path), mask), real_path)
+
+    def rm_watch(self, wd):
+        # the kernel has already dropped watches of deleted directories
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, pos)
+            pos += event_header.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    # re-reads changed files once no events arrived for the debounce interval (or max_delay has passed)
+    # and writes the snapshot at most once per flush interval
+    def __init__(self, collection: Collection, name=snapshot_name, debounce=2.0, max_delay=30.0, flush_interval=60.0):
+        self.collection = collection
+        self.snapshots = collection.snapshots
+        self.name = name
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.flush_interval = flush_interval
+        self.inotify = Inotify()
+        self.dirs = {}
+        self.wds = {}
+        self.pending = set()
+        self.retries = {}
+        self.first_event = None
+        self.last_event = None
+        self.last_flush = time.monotonic()
+        self.dirty = False
+        self.watch_tree('', pend=False)
+
+    def watch_tree(self, path, pend=True):
+        for real_dir, dirs, files in os.walk(self.collection.real_path(path)):
+            rel_dir = posixpath.relpath(real_dir, self.collection.music_root).replace(os.sep, '/')
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            try:
+                wd = self.inotify.add_watch(real_dir)
+            except FileNotFoundError:
+                continue
+            self.dirs[wd] = rel_dir
+            self.wds[rel_dir] = wd
+            if pend:
+                self.pending.update(posixpath.join(rel_dir, f) for f in files)
+
+    def unwatch_tree(self, path):
+        prefix = posixpath.join(path, '')
+        for rel_dir in [d for d in self.wds if d == path or d.startswith(prefix)]:
+            wd = self.wds.pop(rel_dir)
+            self.dirs.pop(wd, None)
+            self.inotify.rm_watch(wd)
+        self.pending.update(p for p in self.collection.by_path if p.startswith(prefix))
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, only a full scan can tell what changed
+            self.watch_tree('', pend=False)
+            self.collection.update()
+            self.dirty = True
+            return
+        rel_dir = self.dirs.get(wd)
+        if rel_dir is None:
+            return
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            if self.wds.get(rel_dir) == wd:
+                del self.wds[rel_dir]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            return
+        path = posixpath.join(rel_dir, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.unwatch_tree(path)
+        else:
+            self.pending.add(path)
+
+    def poll(self, timeout=None):
+        now = time.monotonic()
+        if timeout is None:
+            timeout = self.debounce if self.pending else self.flush_interval
+            if self.retries:
+                timeout = max(0, min(timeout, min(at for at, _ in self.retries.values()) - now))
+        for wd, mask, name in self.inotify.read(timeout):
+            self.handle(wd, mask, name)
+            now = time.monotonic()
+            self.last_event = now
+            if self.first_event is None:
+                self.first_event = now
+
+        now = time.monotonic()
+        for path, (at, _) in list(self.retries.items()):
+            if at <= now and path not in self.pending:
+                self.pending.add(path)
+        if self.pending and (
+            self.last_event is None or
+            now - self.last_event >= self.debounce or
+            now - self.first_event >= self.max_delay
+        ):
+            self.process()
+        if self.dirty and now - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def process(self):
+        paths = sorted(self.pending)
+        self.pending.clear()
+        self.first_event = None
+        self.last_event = None
+        # pictures may have been added or removed by another process since the last batch
+        self.snapshots.pictures.reload()
+        failed = []
+        changed = self.collection.refresh(paths, failed)
+        delays = dict((path, self.retries.pop(path, (None, 0))[1]) for path in paths)
+        for path, ex in failed:
+            # most likely still being copied, so it is retried with a growing delay
+            delay = min(max(2 * delays[path], self.debounce, 1.0), self.max_delay)
+            print('Could not read %s: %r' % (path, ex))
+            self.retries[path] = (time.monotonic() + delay, delay)
+        if changed:
+            print('Updated %d records' % changed)
+            self.dirty = True
+
+    def flush(self):
+        self.snapshots.save(self.collection.state, self.name)
+        self.last_flush = time.monotonic()
+        self.dirty = False
+
+    def run(self):
+        try:
+            while True:
+                self.poll()
+        finally:
+            if self.pending:
+                self.process()
+            if self.dirty:
+                self.flush()
+            self.inotify.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debounce', type=float, default=2.0, help='seconds without changes before files are read')
+    parser.add_argument('--flush-interval', type=float, default=60.0, help='seconds between snapshot writes')
+    parser.add_argument('--verify', choices=verify_levels, default=verify_full, help='serialization check level')
+    args = parser.parse_args()
+
+    snapshots = Snapshots(snapshot_root, verify=args.verify)
+    collection = Collection(snapshots, music_root, need_update=False, progress=ConsoleProgress())
+    # watching starts before the initial scan, so changes made during the scan are read again afterwards
+    watcher = Watcher(collection, debounce=args.debounce, flush_interval=args.flush_interval)
+    if collection.resume_apply() is None:
+        collection.update()
+    snapshots.save(collection.state, snapshot_name)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass